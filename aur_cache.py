@@ -0,0 +1,123 @@
+########################################
+#                                      #
+#                                      #
+#       aur_cache.py - Tony Ward       #
+#                                      #
+#  Built AUR packages, reused across   #
+#  installs instead of rebuilding      #
+#                                      #
+########################################
+
+from install_util import *
+import platform
+import hashlib
+import re
+import os
+
+# Build inputs that decide what makepkg produces
+KEY_FILES = ["PKGBUILD", ".SRCINFO"]
+PKG_SUFFIXES = (".pkg.tar", ".pkg.tar.zst", ".pkg.tar.xz", ".pkg.tar.gz")
+UNCOMPRESSED_SUFFIX = ".pkg.tar"
+# .SRCINFO keys that name packages a build needs
+SRCINFO_DEPS = {"depends", "makedepends", "checkdepends"}
+# Splits a dependency like foo>=1.2 into its name
+DEP_VERSION = re.compile(r"[<>=]")
+
+class AurCache:
+    """
+    Content addressed cache of built AUR packages on the installer host
+    Each build is stored in a directory named by a hash of its PKGBUILD, .SRCINFO
+    and the architecture it was built for
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, pkg_dir):
+        """Hash of the build inputs in pkg_dir, None if they're missing"""
+        digest = hashlib.sha256(platform.machine().encode("utf-8"))
+        for name in KEY_FILES:
+            contents = read_host_file(os.path.join(pkg_dir, name))
+            if contents is None:
+                return None
+            digest.update(name.encode("utf-8") + b"\0" + contents.encode("utf-8"))
+        return digest.hexdigest()
+
+    def lookup(self, key):
+        """Names of the cached package files for key, empty if it hasn't been built"""
+        files = []
+        if key is not None:
+            names = list_dir(os.path.join(self.cache_dir, key)) or []
+            files = [name for name in names if name.endswith(PKG_SUFFIXES)]
+
+        if files:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return files
+
+    def store(self, key, pkg_files):
+        """
+        Copies built package files into the cache under key
+        Uncompressed packages (PKGEXT .pkg.tar) are stored zstd compressed, the cache isn't bounded
+        """
+        key_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = key_dir + ".tmp"
+        make_dirs(tmp_dir)
+        compressed = [path for path in pkg_files if not path.endswith(UNCOMPRESSED_SUFFIX)]
+        if compressed:
+            execute("cp {} {}".format(" ".join(compressed), tmp_dir))
+        for path in pkg_files:
+            if path.endswith(UNCOMPRESSED_SUFFIX):
+                execute("zstd -q -T0 {} -o {}/{}.zst".format(path, tmp_dir, os.path.basename(path)))
+        # Rename so a half copied build is never seen as a hit
+        execute("mv -T {} {}".format(tmp_dir, key_dir))
+
+    def report(self):
+        if self.hits + self.misses == 0:
+            return
+        log("[*] AUR build cache: {} hits, {} misses".format(self.hits, self.misses))
+
+def read_srcinfo(srcinfo_path):
+    """
+    Returns (names, deps) from a .SRCINFO: every package name it builds or provides,
+    and every package its build or runtime needs. Both empty if the file is missing
+    """
+    names, deps = set(), set()
+    for line in (read_host_file(srcinfo_path) or "").splitlines():
+        if " = " not in line:
+            continue
+        key, value = [part.strip() for part in line.split(" = ", 1)]
+        # Architecture specific deps look like depends_x86_64
+        key = key.split("_")[0]
+        if key in ("pkgname", "provides"):
+            names.add(DEP_VERSION.split(value)[0])
+        elif key in SRCINFO_DEPS:
+            deps.add(DEP_VERSION.split(value)[0])
+    return names, deps
+
+def build_waves(pkgs):
+    """
+    Orders AUR packages for building. pkgs maps each package to its (names, deps)
+    Returns a list of waves, each wave only depends on packages in earlier waves
+    """
+    provided = {}
+    for pkg, (names, _) in pkgs.items():
+        for name in names | {pkg}:
+            provided[name] = pkg
+
+    needs = {}
+    for pkg, (_, deps) in pkgs.items():
+        needs[pkg] = {provided[dep] for dep in deps if dep in provided and provided[dep] != pkg}
+
+    waves = []
+    built = set()
+    while len(built) < len(pkgs):
+        wave = sorted(pkg for pkg in pkgs if pkg not in built and needs[pkg] <= built)
+        if not wave:
+            raise Exception("AUR packages depend on each other in a loop: {}".format(
+                ", ".join(sorted(set(pkgs) - built))))
+        waves.append(wave)
+        built.update(wave)
+    return waves
@@ -0,0 +1,185 @@
+########################################
+#                                      #
+#                                      #
+#     build_cache.py - Tony Ward       #
+#                                      #
+#  Go and ccache compiler caches kept  #
+#  on the host for AUR builds          #
+#                                      #
+########################################
+
+from install_util import *
+import os
+import time
+
+# Cache subdirectories, each with its own size limit
+GOMOD = "gomod"
+GOBUILD = "gobuild"
+CCACHE = "ccache"
+CACHES = [GOMOD, GOBUILD, CCACHE]
+# Go build cache entries, one per compile or link action
+GO_ACTION_SUFFIX = "-a"
+# Downloaded module archives under GOMODCACHE
+GO_MOD_DOWNLOADS = os.path.join("cache", "download")
+GO_MOD_ZIP = ".zip"
+CCACHE_CONF = "ccache.conf"
+# ccache --print-stats counters
+CCACHE_HITS = ["direct_cache_hit", "preprocessed_cache_hit"]
+CCACHE_MISSES = ["cache_miss"]
+
+class BuildCache:
+    """
+    Compiler caches on the installer host, bind mounted into the new install for AUR builds
+    GOMODCACHE holds downloaded Go modules, GOCACHE compiled Go packages and ccache compiled C/C++
+    max_sizes has a limit in bytes for each of them
+    """
+    def __init__(self, cache_dir, max_sizes):
+        self.cache_dir = cache_dir
+        self.max_sizes = max_sizes
+        self.start = None
+        self.go_actions = set()
+        self.go_mods = set()
+        self.stats = None
+        self.ccache_stats = None
+
+    def path(self, cache):
+        return os.path.join(self.cache_dir, cache)
+
+    def prepare(self):
+        """Creates the caches and sets ccache's own size limit, chown gives them to the build user"""
+        for cache in CACHES:
+            make_dirs(self.path(cache))
+        # Only the build user may write, anything planted in the caches is linked into installed binaries
+        execute("chmod 755 {}".format(" ".join(self.path(cache) for cache in CACHES)))
+        write_file("max_size = {}Ki\n".format(self.max_sizes[CCACHE] // KB),
+                   os.path.join(self.path(CCACHE), CCACHE_CONF))
+
+    def profile(self, target_dir):
+        """makepkg config lines pointing builds at the caches mounted on target_dir"""
+        return ["export GOMODCACHE={}".format(os.path.join(target_dir, GOMOD)),
+                "export GOCACHE={}".format(os.path.join(target_dir, GOBUILD)),
+                "export CCACHE_DIR={}".format(os.path.join(target_dir, CCACHE)),
+                # makepkg refuses to build with ccache on if it isn't installed. An if, since makepkg
+                # fails when sourcing its config returns non-zero
+                'if command -v ccache >/dev/null; then BUILDENV=("${BUILDENV[@]/!ccache/ccache}"); fi']
+
+    def chown_command(self, target_dir, user):
+        """
+        Command run in the new install giving the caches mounted on target_dir to user
+        The host doesn't know the build user's uid. Only files owned by someone else are changed
+        """
+        return "find {} ! -user {} -exec chown -h {}: {{}} +".format(
+            " ".join(os.path.join(target_dir, cache) for cache in CACHES), user, user)
+
+    def ccache_command(self, target_dir, args):
+        """ccache command line for the cache mounted on target_dir"""
+        return "CCACHE_DIR={} ccache {}".format(os.path.join(target_dir, CCACHE), args)
+
+    def take_snapshot(self):
+        """Remembers what's cached before any AUR package is built"""
+        self.start = time.time()
+        self.go_actions = {path for path, _ in self.go_action_files()}
+        self.go_mods = set(self.go_mod_files())
+
+    def go_action_files(self):
+        """(path, mtime) of every Go build cache entry"""
+        files = []
+        for root, _, names in os.walk(self.path(GOBUILD)):
+            for name in names:
+                if name.endswith(GO_ACTION_SUFFIX):
+                    path = os.path.join(root, name)
+                    files.append((path, os.path.getmtime(path)))
+        return files
+
+    def go_mod_files(self):
+        """Paths of every downloaded Go module archive"""
+        files = []
+        for root, _, names in os.walk(os.path.join(self.path(GOMOD), GO_MOD_DOWNLOADS)):
+            files += [os.path.join(root, name) for name in names if name.endswith(GO_MOD_ZIP)]
+        return files
+
+    def count_hits(self, ccache_stats=""):
+        """
+        Works out hits since take_snapshot. Go marks a build cache entry as used by touching it
+        (at most hourly), so old entries touched since the snapshot are hits and new ones misses
+        ccache_stats is the output of ccache --print-stats, empty if ccache wasn't used
+        Returns None without a snapshot, the builds ran in an earlier run of a resumed install
+        """
+        if self.start is None:
+            return None
+
+        go_hits, go_misses = 0, 0
+        for path, mtime in self.go_action_files():
+            if path not in self.go_actions:
+                go_misses += 1
+            elif mtime >= self.start:
+                go_hits += 1
+
+        mods = self.go_mod_files()
+        new_mods = len([path for path in mods if path not in self.go_mods])
+        self.stats = {"go_hits": go_hits, "go_misses": go_misses,
+                      "mods_cached": len(mods) - new_mods, "mods_downloaded": new_mods}
+
+        counters = {}
+        for line in ccache_stats.splitlines():
+            fields = line.split("\t")
+            if len(fields) == 2 and fields[1].isdigit():
+                counters[fields[0]] = int(fields[1])
+        if counters:
+            self.ccache_stats = {"hits": sum(counters.get(key, 0) for key in CCACHE_HITS),
+                                 "misses": sum(counters.get(key, 0) for key in CCACHE_MISSES)}
+        return self.stats
+
+    def evict(self):
+        """
+        Keeps the Go caches under their limits, ccache does its own
+        Least recently used build cache entries go first, the module cache is emptied if it's
+        too big since Go won't redownload a module with files missing
+        """
+        gobuild = self.path(GOBUILD)
+        files = []
+        for root, _, names in os.walk(gobuild):
+            for name in names:
+                path = os.path.join(root, name)
+                stat = os.lstat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        freed = 0
+        for _, size, path in sorted(files):
+            if total - freed <= self.max_sizes[GOBUILD]:
+                break
+            remove_file(path)
+            freed += size
+        if freed:
+            log("[*] Evicted {:.1f} MB from Go build cache".format(freed / MB))
+
+        gomod = self.path(GOMOD)
+        size = dir_size(gomod)
+        if size > self.max_sizes[GOMOD]:
+            # Module files are read only
+            execute("chmod -R u+w {}".format(gomod))
+            execute("find {} -mindepth 1 -delete".format(gomod))
+            log("[*] Emptied Go module cache ({:.1f} MB)".format(size / MB))
+
+    def report(self):
+        """Logs hit rates for the install"""
+        if self.stats is None:
+            return
+        lookups = self.stats["go_hits"] + self.stats["go_misses"]
+        rate = 100 * self.stats["go_hits"] / lookups if lookups else 0
+        log("[*] Go build cache: {} hits, {} misses, {:.0f}% hit rate".format(
+            self.stats["go_hits"], self.stats["go_misses"], rate))
+        log("[*] Go module cache: {} modules cached, {} downloaded".format(
+            self.stats["mods_cached"], self.stats["mods_downloaded"]))
+        if self.ccache_stats is not None:
+            lookups = self.ccache_stats["hits"] + self.ccache_stats["misses"]
+            rate = 100 * self.ccache_stats["hits"] / lookups if lookups else 0
+            log("[*] ccache: {} hits, {} misses, {:.0f}% hit rate".format(
+                self.ccache_stats["hits"], self.ccache_stats["misses"], rate))
+
+def dir_size(path):
+    """Total size in bytes of the files under path"""
+    total = 0
+    for root, _, names in os.walk(path):
+        total += sum(os.lstat(os.path.join(root, name)).st_size for name in names)
+    return total
@@ -0,0 +1,219 @@
+########################################
+#                                      #
+#                                      #
+#     cache_proxy.py - Tony Ward       #
+#                                      #
+#  Caching pacman mirror for installs  #
+#  run from the same imaging station   #
+#                                      #
+########################################
+
+from install_util import *
+from mirrors import mirror_url
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import shutil
+import time
+import re
+import os
+
+# Requests look like a mirror with Server = http://<proxy>/$repo/os/$arch
+PROXY_PATH = re.compile(r"^/([\w.-]+)/os/([\w.-]+)/([^/]+)$")
+# Path components that would lead out of the cache dir
+PROXY_BAD_PARTS = {".", ".."}
+# Databases change upstream, they're refetched once they are this many seconds old
+DB_FILE = re.compile(r"\.(db|files)(\.sig)?$")
+DB_MAX_AGE = 60
+# Bytes read from upstream at a time
+FETCH_CHUNK = 1024 * 1024
+RANGE_HEADER = re.compile(r"^bytes=(\d+)-(\d*)$")
+
+class CacheProxy:
+    """
+    Fetches each file from upstream mirrors once and serves it from disk after that
+    Concurrent requests for a file being fetched wait for that fetch instead of starting
+    their own. Least recently used files are evicted to keep the cache under max_size
+    """
+    def __init__(self, cache_dir, max_size, upstream):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.upstream = upstream
+        self.lock = threading.Lock()
+        self.fetching = {}
+        self.stats = {"hits": 0, "misses": 0, "served_bytes": 0, "fetched_bytes": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.cached_files())
+
+    def cached_files(self):
+        """(path, size, atime) of every file in the cache"""
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".part"):
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                files.append((path, stat.st_size, stat.st_atime))
+        return files
+
+    def get(self, repo, arch, file_name):
+        """Returns the cached path for a file, fetching it if needed. None if upstream doesn't have it"""
+        path = os.path.join(self.cache_dir, repo, "os", arch, file_name)
+        if not os.path.realpath(path).startswith(os.path.realpath(self.cache_dir) + os.sep):
+            raise Exception("{} is outside the cache".format(path))
+
+        while True:
+            with self.lock:
+                if self.is_fresh(path):
+                    self.stats["hits"] += 1
+                    # Marks it as recently used for eviction, mtime is left as when it was fetched
+                    os.utime(path, (time.time(), os.path.getmtime(path)))
+                    return path
+                event = self.fetching.get(path)
+                if event is None:
+                    event = threading.Event()
+                    self.fetching[path] = event
+                    self.stats["misses"] += 1
+                    break
+            # Someone else is fetching it, check again once they're done
+            event.wait()
+            if not os.path.exists(path):
+                return None
+
+        try:
+            fetched = self.fetch(repo, arch, file_name, path)
+        finally:
+            with self.lock:
+                del self.fetching[path]
+            event.set()
+
+        if fetched:
+            self.evict()
+            return path
+        return None
+
+    def is_fresh(self, path):
+        if not os.path.exists(path):
+            return False
+        if DB_FILE.search(path):
+            return time.time() - os.path.getmtime(path) < DB_MAX_AGE
+        return True
+
+    def fetch(self, repo, arch, file_name, path):
+        """Downloads a file from the first upstream mirror that has it"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part = path + ".part"
+
+        for server in self.upstream:
+            url = mirror_url(server, repo, arch, file_name)
+            try:
+                resp = request.urlopen(url, timeout=30)
+                file = open(part, "wb")
+                shutil.copyfileobj(resp, file, FETCH_CHUNK)
+                file.close()
+                resp.close()
+            except Exception:
+                continue
+
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            new_size = os.path.getsize(part)
+            os.replace(part, path)
+            with self.lock:
+                self.size += new_size - old_size
+                self.stats["fetched_bytes"] += new_size
+            return True
+
+        if os.path.exists(part):
+            os.remove(part)
+        return False
+
+    def evict(self):
+        """Deletes least recently used files until the cache is under max_size"""
+        with self.lock:
+            if self.size <= self.max_size:
+                return
+            files = self.cached_files()
+            files.sort(key=lambda item: item[2])
+            for path, size, _ in files:
+                if self.size <= self.max_size:
+                    break
+                if path in self.fetching:
+                    continue
+                os.remove(path)
+                self.size -= size
+
+    def report(self):
+        log("[*] Cache proxy: {} hits, {} misses, {:.1f} MB served, {:.1f} MB fetched upstream".format(
+            self.stats["hits"], self.stats["misses"], self.stats["served_bytes"] / MB,
+            self.stats["fetched_bytes"] / MB))
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    """Serves cached files with sendfile, supports single byte ranges for resumed downloads"""
+    def do_GET(self):
+        match = PROXY_PATH.match(self.path)
+        if match is None or PROXY_BAD_PARTS.intersection(match.groups()):
+            self.send_error(404)
+            return
+
+        path = self.server.proxy.get(*match.groups())
+        if path is None:
+            self.send_error(404)
+            return
+
+        file = open(path, "rb")
+        try:
+            size = os.fstat(file.fileno()).st_size
+            start, end = 0, size - 1
+            range_match = RANGE_HEADER.match(self.headers.get("Range", ""))
+            if range_match is not None:
+                start = int(range_match.group(1))
+                if range_match.group(2) != "":
+                    end = min(int(range_match.group(2)), size - 1)
+                if start >= size or end < start:
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            self.wfile.flush()
+
+            # Straight from the page cache to the socket
+            offset, remaining = start, end - start + 1
+            while remaining > 0:
+                sent = os.sendfile(self.connection.fileno(), file.fileno(), offset, remaining)
+                if sent == 0:
+                    break
+                offset += sent
+                remaining -= sent
+            with self.server.proxy.lock:
+                self.server.proxy.stats["served_bytes"] += offset - start
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            file.close()
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_cache(port, cache_dir, max_size, upstream):
+    """Runs the caching proxy until interrupted"""
+    if not upstream:
+        raise Exception("No upstream mirrors for cache proxy")
+
+    proxy = CacheProxy(cache_dir, max_size, upstream)
+    server = ThreadingHTTPServer(("", port), ProxyHandler)
+    server.daemon_threads = True
+    server.proxy = proxy
+
+    log("[*] Serving package cache from {} on port {}".format(cache_dir, port))
+    log("[*] Point installs at it with: Server = http://<this host>:{}/$repo/os/$arch".format(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        proxy.report()
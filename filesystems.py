@@ -0,0 +1,168 @@
+########################################
+#                                      #
+#                                      #
+#     filesystems.py - Tony Ward       #
+#                                      #
+#  Filesystem backends for root and    #
+#  home, with mkfs and mount presets   #
+#                                      #
+########################################
+
+from install_util import *
+import tempfile
+import os
+
+# mkfs.ext4 options for each format profile, chosen per volume with format_profile_<volume>
+# fast leaves zeroing the inode tables and journal to the kernel after first mount, and turns on
+# fast_commit. discard picks discard or nodiscard from the device type. default is plain mkfs.ext4
+EXT4_PROFILES = {
+    "fast": {"extended": ["lazy_itable_init=1", "lazy_journal_init=1"], "features": ["fast_commit"],
+             "discard": True},
+    "full": {"extended": ["lazy_itable_init=0", "lazy_journal_init=0"], "features": [], "discard": True},
+    "default": {"extended": [], "features": [], "discard": False},
+}
+# Btrfs subvolume each volume is mounted from, so snapshots can be taken and rolled back per volume
+BTRFS_SUBVOLUMES = {"root": "@", "home": "@home"}
+# xfs allocation groups can't be smaller than this
+XFS_MIN_AG_SIZE = 16 * MB
+XFS_MAX_AGCOUNT = 32
+
+class Filesystem:
+    """
+    How root or home is formatted and mounted. volume is root or home, profile its format_profile
+    Backends give mkfs args, mount options while installing, options the installed system
+    mounts with (written to fstab) and the packages the installed system needs for the filesystem
+    """
+    name = ""
+    packages = []
+    # Mount options during the install, the new system is thrown away if the install fails
+    install_options = "noatime"
+    # Mount options written to fstab
+    runtime_options = "rw,noatime"
+
+    def __init__(self, volume, profile):
+        self.volume = volume
+        self.profile = profile
+
+    def mkfs_args(self, device):
+        """Returns (mkfs command, description of the settings used)"""
+        raise NotImplementedError
+
+    def format(self, device):
+        """Formats device, returns (returncode, description of the settings used)"""
+        cmd, settings = self.mkfs_args(device)
+        return execute(cmd).returncode, settings
+
+    def mount(self, device, target):
+        """Mounts device on target with the install options"""
+        return execute("mount -o {} {} {}".format(self.install_options, device, target)).returncode
+
+    def fstab_options(self):
+        return self.runtime_options
+
+    def fsck_pass(self):
+        """fstab pass number, 0 skips checking at boot"""
+        return 0
+
+class Ext4(Filesystem):
+    name = "ext4"
+    # commit=60 batches journal writes while pacstrap is writing thousands of files
+    install_options = "noatime,commit=60"
+
+    def __init__(self, volume, profile):
+        # Checked up front, a typo must not stop the install after the disk was wiped
+        if profile not in EXT4_PROFILES:
+            raise Exception("Unknown format_profile_{} - {}, choose from {}".format(
+                volume, profile, ", ".join(sorted(EXT4_PROFILES))))
+        Filesystem.__init__(self, volume, profile)
+
+    def mkfs_args(self, device):
+        profile = EXT4_PROFILES[self.profile]
+
+        extended = list(profile["extended"])
+        if profile["discard"]:
+            # Discarding an ssd up front is quick and leaves it fully trimmed, hdds can't discard
+            # and dm-crypt only passes discards on if it was opened to
+            queue = block_queue(device)
+            if queue is not None and not queue["rotational"] and queue["discard"]:
+                extended.append("discard")
+            else:
+                extended.append("nodiscard")
+
+        args = ""
+        if extended:
+            args += "-E {} ".format(",".join(extended))
+        if profile["features"]:
+            args += "-O {} ".format(",".join(profile["features"]))
+        settings = "ext4 {} profile{}".format(self.profile, ": " + args.strip() if args else "")
+        return "mkfs.ext4 {}{}".format(args, device), settings
+
+    def fsck_pass(self):
+        return 1 if self.volume == "root" else 2
+
+class Xfs(Filesystem):
+    name = "xfs"
+    packages = ["xfsprogs"]
+
+    def mkfs_args(self, device):
+        # More allocation groups let an ssd allocate for that many writers at once,
+        # on hdds the default keeps seeks down
+        queue = block_queue(device)
+        if queue is None or queue["rotational"] or queue["size"] == 0:
+            return "mkfs.xfs -f {}".format(device), "xfs default agcount"
+        agcount = max(4, min(cpu_count(), XFS_MAX_AGCOUNT, queue["size"] // XFS_MIN_AG_SIZE))
+        return "mkfs.xfs -f -d agcount={} {}".format(agcount, device), "xfs agcount={}".format(agcount)
+
+class Btrfs(Filesystem):
+    name = "btrfs"
+    packages = ["btrfs-progs"]
+
+    def __init__(self, volume, profile):
+        Filesystem.__init__(self, volume, profile)
+        subvol = BTRFS_SUBVOLUMES[volume]
+        # Fast compression while installing, the default level once installed
+        self.install_options = "noatime,compress=zstd:1,subvol={}".format(subvol)
+        self.runtime_options = "rw,noatime,compress=zstd:3,subvol={}".format(subvol)
+
+    def mkfs_args(self, device):
+        return "mkfs.btrfs -f {}".format(device), "btrfs zstd, subvolume {}".format(BTRFS_SUBVOLUMES[self.volume])
+
+    def format(self, device):
+        """Formats device and creates the volume's subvolume"""
+        returncode, settings = Filesystem.format(self, device)
+        if returncode != 0:
+            return returncode, settings
+
+        top_level = tempfile.mkdtemp()
+        returncode = execute("mount {} {}".format(device, top_level)).returncode
+        if returncode == 0:
+            returncode = execute("btrfs subvolume create {}/{}".format(
+                top_level, BTRFS_SUBVOLUMES[self.volume])).returncode
+            # Left mounted, the device can't be mounted again with the subvolume
+            umount_returncode = execute("umount {}".format(top_level)).returncode
+            if umount_returncode != 0:
+                log("[!] Failed to unmount {} from {}".format(device, top_level))
+                return umount_returncode, settings
+        # Only removes the directory if nothing is mounted on it
+        os.rmdir(top_level)
+        return returncode, settings
+
+class F2fs(Filesystem):
+    name = "f2fs"
+    packages = ["f2fs-tools"]
+    # lazytime keeps inode time updates in memory, f2fs is meant for flash
+    install_options = "noatime,lazytime"
+    runtime_options = "rw,noatime,lazytime"
+
+    def mkfs_args(self, device):
+        # No extra_attr or compression, grub can't read f2fs root with them
+        return "mkfs.f2fs -f {}".format(device), "f2fs"
+
+FILESYSTEMS = {fs.name: fs for fs in [Ext4, Xfs, Btrfs, F2fs]}
+
+def get_filesystem(name, volume, profile):
+    """Backend for volume (root or home) from its filesystem_<volume> setting"""
+    if name not in FILESYSTEMS:
+        raise Exception("Unknown filesystem_{} - {}, choose from {}".format(
+            volume, name, ", ".join(sorted(FILESYSTEMS))))
+    return FILESYSTEMS[name](volume, profile)
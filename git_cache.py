@@ -0,0 +1,95 @@
+########################################
+#                                      #
+#                                      #
+#       git_cache.py - Tony Ward       #
+#                                      #
+#  Bare mirrors of cloned repos, so    #
+#  installs clone locally              #
+#                                      #
+########################################
+
+from install_util import *
+import threading
+import hashlib
+import re
+import os
+
+# Touched after every successful fetch, its mtime is when the mirror was last refreshed
+FETCH_STAMP = "install-fetched"
+# Characters kept from a repo url when naming its mirror
+MIRROR_NAME_CHARS = re.compile(r"[^A-Za-z0-9._-]")
+
+class GitCache:
+    """
+    Bare mirrors of every repo the installer clones, kept on the installer host
+    Mirrors are fetched at most once every ttl seconds, installs clone from them locally
+    """
+    def __init__(self, cache_dir, ttl):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.repo_locks = {}
+        self.stats = {"fresh": 0, "fetched": 0, "cloned": 0, "stale": 0}
+
+    def mirror_name(self, repo):
+        """Directory name of repo's mirror, readable but unique per url"""
+        name = repo.rstrip("/").split("/")[-1]
+        if name.endswith(".git"):
+            name = name[:-len(".git")]
+        digest = hashlib.sha1(repo.encode("utf-8")).hexdigest()[:12]
+        return "{}-{}.git".format(MIRROR_NAME_CHARS.sub("_", name), digest)
+
+    def update(self, repo):
+        """
+        Makes sure repo has an up to date mirror, returns the mirror's name in cache_dir
+        An out of date mirror is still used if fetching fails. Returns None if there's no mirror
+        """
+        with self.lock:
+            repo_lock = self.repo_locks.setdefault(repo, threading.Lock())
+
+        # Clones of the same repo running at once share one fetch
+        with repo_lock:
+            name = self.mirror_name(repo)
+            mirror = os.path.join(self.cache_dir, name)
+            stamp = os.path.join(mirror, FETCH_STAMP)
+
+            if list_dir(mirror) is not None:
+                age = file_age(stamp)
+                if age is not None and age < self.ttl:
+                    self.count("fresh")
+                    return name
+                # Mirrors fetch every ref, --prune drops deleted branches
+                proc = execute("git -C {} fetch -q --prune origin".format(mirror))
+                if proc.returncode != 0:
+                    log("[!] Couldn't refresh git mirror of {}, using it as is".format(repo))
+                    self.count("stale")
+                    return name
+                write_file("", stamp)
+                self.count("fetched")
+                return name
+
+            tmp = mirror + ".tmp"
+            if path_exists(tmp):
+                execute("rm -rf {}".format(tmp))
+            proc = execute("git clone -q --mirror {} {}".format(repo, tmp))
+            if proc.returncode != 0:
+                log("[!] Couldn't mirror {}".format(repo))
+                return None
+            # Lets pinned commits be fetched from the mirror by sha
+            execute("git -C {} config uploadpack.allowAnySHA1InWant true".format(tmp))
+            write_file("", os.path.join(tmp, FETCH_STAMP))
+            # Rename so a half cloned mirror is never used
+            execute("mv -T {} {}".format(tmp, mirror))
+            self.count("cloned")
+            return name
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def report(self):
+        """Logs how many clones were served from the mirrors without going to the network"""
+        if sum(self.stats.values()) == 0:
+            return
+        log("[*] Git mirrors: {} fresh, {} fetched, {} newly mirrored, {} stale".format(
+            self.stats["fresh"], self.stats["fetched"], self.stats["cloned"], self.stats["stale"]))
@@ -0,0 +1,184 @@
+########################################
+#                                      #
+#                                      #
+#     image_stream.py - Tony Ward      #
+#                                      #
+#  Pipelined read -> decompress ->     #
+#  write for deploying images          #
+#                                      #
+########################################
+
+from urllib import request
+import subprocess
+import threading
+import queue
+import fcntl
+import mmap
+import time
+import os
+
+# Size of each buffer passed between stages, page aligned since they're mmapped
+CHUNK_SIZE = 4 * 1024 * 1024
+# Buffers in flight between each pair of stages, bounds memory use and lets stages run ahead
+STAGE_BUFFERS = 4
+# Pipe size between the install and each command, the kernel default is 64K
+PIPE_SIZE = 1024 * 1024
+# Seconds between progress callbacks
+PROGRESS_INTERVAL = 5
+
+class StreamPipeline:
+    """
+    Feeds a file or URL through a chain of commands, eg. zstd -dc then tar -x
+    Reading, each command and the copying between them run at the same time, on their own
+    threads and processes. Data moves in large reusable buffers through bounded queues, so
+    a slow stage holds the others back instead of using up memory
+    """
+    def __init__(self, source, cmds, chunk_size=CHUNK_SIZE, buffers=STAGE_BUFFERS):
+        """cmds is a list of commands, each a list of args"""
+        self.source = source
+        self.cmds = cmds
+        self.chunk_size = chunk_size
+        self.buffers = buffers
+        self.total = None
+        # Bytes fed into each command
+        self.fed = [0] * len(cmds)
+        self.errors = []
+        self.start = None
+
+    def stats(self):
+        return {"total": self.total, "fed": list(self.fed), "elapsed": time.monotonic() - self.start}
+
+    def run(self, on_progress=None, interval=PROGRESS_INTERVAL):
+        """Runs the pipeline to completion, returns its stats, raises if any stage failed"""
+        self.start = time.monotonic()
+        last = len(self.cmds) - 1
+        procs = []
+        for i, cmd in enumerate(self.cmds):
+            stdout = subprocess.PIPE if i < last else subprocess.DEVNULL
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=stdout, bufsize=0)
+            grow_pipe(proc.stdin)
+            if i < last:
+                grow_pipe(proc.stdout)
+            procs.append(proc)
+
+        # One pool of free buffers and one queue of filled buffers into each command
+        pools = [self.make_pool() for _ in procs]
+        filled = [queue.Queue(maxsize=self.buffers) for _ in procs]
+
+        threads = [threading.Thread(target=self.read_source, args=(pools[0], filled[0]))]
+        for i, proc in enumerate(procs):
+            threads.append(threading.Thread(target=self.feed, args=(i, proc, pools[i], filled[i])))
+            if i < last:
+                threads.append(threading.Thread(target=self.pump, args=(proc, pools[i + 1], filled[i + 1])))
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(interval)
+                if thread.is_alive() and on_progress is not None:
+                    on_progress(self.stats())
+
+        for cmd, proc in zip(self.cmds, procs):
+            if proc.wait() != 0:
+                self.errors.append("{} exited with {}".format(cmd[0], proc.returncode))
+        if self.errors:
+            raise Exception("Streaming {} failed - {}".format(self.source, "; ".join(self.errors)))
+        return self.stats()
+
+    def make_pool(self):
+        pool = queue.Queue()
+        for _ in range(self.buffers):
+            pool.put(mmap.mmap(-1, self.chunk_size))
+        return pool
+
+    def read_source(self, pool, filled):
+        """Reads the source into buffers for the first command"""
+        try:
+            if self.source.startswith(("http://", "https://")):
+                src = request.urlopen(self.source)
+                length = src.headers.get("Content-Length")
+                self.total = int(length) if length is not None else None
+                fd = None
+            else:
+                src = open(self.source, "rb", buffering=0)
+                fd = src.fileno()
+                self.total = os.fstat(fd).st_size
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+            offset = 0
+            while True:
+                buf = pool.get()
+                n = read_full(src, buf)
+                if n == 0:
+                    pool.put(buf)
+                    break
+                # The image is read once, don't let it push everything else out of the page cache
+                if fd is not None:
+                    os.posix_fadvise(fd, offset, n, os.POSIX_FADV_DONTNEED)
+                offset += n
+                filled.put((buf, n))
+            src.close()
+        except Exception as e:
+            self.errors.append("reading {}: {}".format(self.source, e))
+        finally:
+            filled.put(None)
+
+    def feed(self, index, proc, pool, filled):
+        """Writes filled buffers into a command, then hands them back to be refilled"""
+        failed = False
+        while True:
+            item = filled.get()
+            if item is None:
+                break
+            buf, n = item
+            # After a failure keep draining so the stage before doesn't block forever
+            if not failed:
+                try:
+                    view = memoryview(buf)[:n]
+                    while view:
+                        view = view[proc.stdin.write(view):]
+                    self.fed[index] += n
+                except Exception as e:
+                    self.errors.append("writing to {}: {}".format(self.cmds[index][0], e))
+                    failed = True
+            pool.put(buf)
+
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+
+    def pump(self, proc, pool, filled):
+        """Reads a command's output into buffers for the next command"""
+        try:
+            while True:
+                buf = pool.get()
+                n = read_full(proc.stdout, buf)
+                if n == 0:
+                    pool.put(buf)
+                    break
+                filled.put((buf, n))
+        except Exception as e:
+            self.errors.append("reading from {}: {}".format(proc.args[0], e))
+        finally:
+            proc.stdout.close()
+            filled.put(None)
+
+def read_full(src, buf):
+    """Reads into buf until it's full or src ends, returns bytes read"""
+    view = memoryview(buf)
+    filled = 0
+    while filled < len(view):
+        n = src.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+    return filled
+
+def grow_pipe(pipe):
+    """Larger pipes mean fewer context switches between the install and its commands"""
+    try:
+        fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+    except OSError:
+        pass
@@ -17,12 +17,23 @@
 #!/usr/bin/python
 from urllib import request
 from install_util import *
+from pkg_cache import PackageCache, PKG_FILE
+import mirrors
+import pkg_lock
+from aur_cache import AurCache, PKG_SUFFIXES, read_srcinfo, build_waves
+from build_cache import BuildCache, GOMOD, GOBUILD, CCACHE, dir_size
+import cache_proxy
+from filesystems import get_filesystem
+from git_cache import GitCache
 from configparser import ConfigParser
 import os
 import subprocess
 import re
 import time
 import getpass
+import json
+import argparse
+import tempfile
 
 # Constants for loading and validating install config
 CONF_FILE = "config.txt"
@@ -33,6 +44,28 @@ CONFIG_FILE_SETTINGS = {"mount_path", "efi_size", "swap_size", "root_size", "luk
                         "ohmyzsh_install_cmd", "dotfiles_repo"}
 CONFIG_RUNTIME_SETTINGS = {"install_disk", "partitions.phys.efi", "partitions.phys.luks",
                            "partitions.lvm.swap", "partitions.lvm.root", "partitions.lvm.home"}
+# Settings that may be left out of the config file, and their default values
+CONFIG_DEFAULT_SETTINGS = {"state_file": "install_state.json", "pkg_cache_dir": "/var/cache/install/pkg",
+                           "pkg_cache_max_size": "20G", "mirror_candidates": "", "mirror_count": "10",
+                           "mirror_cache": "mirror_rank.json", "mirror_ttl": "21600",
+                           "mirror_probe_bytes": "262144", "mirror_probe_timeout": "5",
+                           "cache_proxy": "", "cache_proxy_port": "8080",
+                           "cache_proxy_dir": "/var/cache/install-proxy", "cache_proxy_max_size": "50G",
+                           "cache_proxy_upstream": "", "lock_file": "config.lock",
+                           "aur_cache_dir": "/var/cache/install/aur",
+                           "aur_build_jobs": "", "makepkg_pkgext": ".pkg.tar",
+                           "build_cache_dir": "/var/cache/install/build", "gomodcache_max_size": "5G",
+                           "gocache_max_size": "5G", "ccache_max_size": "5G",
+                           "image_file": "arch.tar.zst", "image_build_dir": "/var/tmp/install_image",
+                           "format_profile_root": "fast", "format_profile_home": "fast",
+                           "filesystem_root": "ext4", "filesystem_home": "ext4",
+                           "offline_dir": "", "yay_ref": "", "dotfiles_ref": "", "ohmyzsh_ref": "",
+                           "git_cache_dir": "/var/cache/install/git", "git_cache_ttl": "3600",
+                           "log_dir": "install_logs", "trace_file": "install_trace.jsonl"}
+# Caches kept on the installer host between installs
+CACHE_DIR_SETTINGS = ["pkg_cache_dir", "aur_cache_dir", "build_cache_dir", "git_cache_dir"]
+# stat -f names of filesystems that live in memory, the live ISO's root is an overlay on one
+MEMORY_FILESYSTEMS = {"tmpfs", "ramfs", "overlayfs"}
 
 # Positions of useful information from lsblk command
 # lsblk output: <NAME>  <MAJ:MIN>   <RM>    <SIZE>  <RO>    <TYPE>    <MOUNTPOINTS>
@@ -47,20 +80,153 @@ SFDISK_PART = ", {}, U\n,,"
 
 # Repo to install yay
 YAY_REPO = "https://aur.archlinux.org/yay.git"
+# A ref that's a full commit sha, which has to be fetched rather than cloned
+GIT_SHA = re.compile(r"^[0-9a-f]{40}$")
+GIT_BUNDLE_SUFFIX = ".bundle"
+# Where ohmyzsh's installer clones from
+OHMYZSH_REPO = "https://github.com/ohmyzsh/ohmyzsh.git"
+# The host git mirrors are bind mounted here in the new install
+TARGET_GIT_CACHE = "var/cache/git"
+# Mirrors belong to root on the host, let the sudo user clone from them
+GIT_SAFE_DIRECTORY = "safe.directory='*'"
+# Any other AUR package, formatted with its name
+AUR_REPO = "https://aur.archlinux.org/{}.git"
+# The host AUR build cache is bind mounted here in the new install
+TARGET_AUR_CACHE = "var/cache/aur"
+# The host Go and ccache caches are bind mounted here in the new install
+TARGET_BUILD_CACHE = "var/cache/build"
+
+# Pacman database used to resolve prefetched packages, appended to pkg_cache_dir
+PREFETCH_DB_SUFFIX = ".db"
+# Where pacman looks for packages in the new install, the host cache is bind mounted here
+TARGET_PKG_CACHE = "var/cache/pacman/pkg"
+
+# makepkg config used for AUR builds during the install, sources the stock /etc/makepkg.conf
+# and overrides it for speed so the stock config is never changed
+MAKEPKG_PROFILE = "/etc/makepkg.install.conf"
+# Build dir in the new install, a tmpfs while AUR packages are built
+MAKEPKG_BUILDDIR = "tmp/makepkg"
+# Share of available memory the build tmpfs may use, and the least worth mounting
+MAKEPKG_TMPFS_RATIO = 0.5
+MAKEPKG_TMPFS_MIN = "2G"
+
+# Volumes with a choice of filesystem, set with filesystem_<volume>
+FS_VOLUMES = ["root", "home"]
+# Where each volume is mounted in the new install
+FS_MOUNT_POINTS = {"root": "/", "home": "/home"}
+
+# Layout of an offline_dir, everything an install would otherwise download
+# A pacman repo named offline, made with repo-add
+OFFLINE_REPO_NAME = "offline"
+OFFLINE_REPO = "repo"
+# Prebuilt AUR packages, yay included
+OFFLINE_AUR = "aur"
+# git bundles of dotfiles_repo and ohmyzsh, and ohmyzsh's tools/install.sh
+OFFLINE_DOTFILES = "dotfiles.bundle"
+OFFLINE_OHMYZSH = "ohmyzsh.bundle"
+OFFLINE_OHMYZSH_INSTALL = "ohmyzsh-install.sh"
+# offline_dir is bind mounted here in the new install
+TARGET_OFFLINE = "var/cache/offline"
+# pacman config using only the offline repo, removed once nothing else is installed
+OFFLINE_PACMAN_CONF = "/etc/pacman.offline.conf"
+OFFLINE_PACMAN_CONF_TEMPLATE = """[options]
+Architecture = auto
+
+[{}]
+SigLevel = Optional TrustAll
+Server = file://{}
+"""
+
+# Passed to tar for golden images, keeps file capabilities and ACLs
+IMAGE_TAR_ARGS = "--xattrs --xattrs-include=*.* --acls --numeric-owner"
+# Regenerated on first boot so every deployed machine gets its own
+IMAGE_EXCLUDES = ["./etc/machine-id"]
+
+# Sudoers rule letting the sudo user run makepkg and yay unattended, removed at the end of the install
+INSTALL_SUDOERS = "/etc/sudoers.d/00-install"
 
 def main():
+    parser = argparse.ArgumentParser(description="Installs Arch Linux how I like it")
+    parser.add_argument("command", nargs="?", default="install",
+                        choices=["install", "build-image", "deploy", "serve-cache", "lock"],
+                        help="install (default), build-image to build the system once into image_file, "
+                             "deploy to install image_file onto this machine, serve-cache to run a "
+                             "package cache for other installs, or lock to resolve the exact packages "
+                             "pacstrap installs into lock_file")
+    parser.add_argument("--offline", metavar="DIR",
+                        help="install from the repo, prebuilt AUR packages and git bundles in DIR "
+                             "instead of the internet")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue a failed install from its first unfinished step")
+    parser.add_argument("--dry-run", nargs="?", const="", metavar="SPEC",
+                        help="print the commands an install would run without running them, "
+                             "SPEC is an optional JSON file of canned outputs and prompt answers")
+    parser.add_argument("--simulate", metavar="SPEC",
+                        help="like --dry-run, but commands take time drawn from the latencies in SPEC")
+    parser.add_argument("--plan", metavar="FILE", default="",
+                        help="with --dry-run or --simulate, write the planned commands to FILE")
+    parser.add_argument("--record", metavar="ARCHIVE",
+                        help="record every command of a real install to ARCHIVE")
+    parser.add_argument("--replay", metavar="ARCHIVE",
+                        help="run the install against a recorded ARCHIVE instead of this machine")
+    parser.add_argument("--replay-scale", metavar="SCALE", type=float, default=1.0,
+                        help="multiply recorded command durations by SCALE when replaying")
+    args = parser.parse_args()
+
+    if args.command in ("serve-cache", "lock"):
+        try:
+            installer = Installer(CONF_FILE)
+            if args.command == "serve-cache":
+                installer.serve_cache()
+            elif args.command == "lock":
+                installer.lock_packages()
+        except Exception as e:
+            log("[!] {}".format(e))
+        return
+
+    simulated = args.dry_run is not None or args.simulate is not None or args.replay is not None
+    if args.replay is not None:
+        set_executor(ReplayExecutor(args.replay, args.replay_scale))
+    elif args.simulate is not None:
+        set_executor(load_simulation(args.simulate))
+    elif args.dry_run is not None:
+        set_executor(load_simulation(args.dry_run, simulate=False))
+    elif args.record is not None:
+        set_executor(RecordingExecutor(args.record))
+
     log("[*] Install commencing")
 
-    if not has_network():
-        exit()
-    time.sleep(1)
-    
     try:
         installer = Installer(CONF_FILE)
-        installer.full_install()
+        if args.offline is not None:
+            installer.config["offline_dir"] = os.path.abspath(args.offline)
+        # Deploying only needs the image, offline installs only need offline_dir
+        if not simulated and args.command != "deploy" and installer.config["offline_dir"] == "" \
+                and not has_network():
+            exit()
+        time.sleep(1)
+
+        if simulated:
+            # Don't clobber the state, logs or trace of a real install on this machine
+            sim_dir = tempfile.mkdtemp()
+            installer.config["state_file"] = os.path.join(sim_dir, "install_state.json")
+            installer.config["log_dir"] = os.path.join(sim_dir, "install_logs")
+            installer.config["trace_file"] = os.path.join(sim_dir, "install_trace.jsonl")
+            set_output_log_dir(installer.config["log_dir"])
+            set_trace_file(installer.config["trace_file"])
+            log("[*] Simulated run, state, logs and trace are in {}".format(sim_dir))
+        installer.full_install(resume=args.resume, mode=args.command)
     except Exception as e:
         log("[!] {}".format(e))
 
+    if simulated and args.plan != "":
+        get_executor().write_plan(args.plan)
+    if args.record is not None:
+        get_executor().close()
+    # Fail CI runs when a change adds, drops or moves commands
+    if args.replay is not None and not get_executor().report():
+        exit(1)
+
 
 class Installer:
     """Holds installation config and executes discrete installation steps"""
@@ -85,33 +251,296 @@ class Installer:
             if not key in self.config:
                 raise Exception("Key {} missing from Install.Config section of config".format(key))
 
+        for key, value in CONFIG_DEFAULT_SETTINGS.items():
+            if not key in self.config:
+                self.config[key] = value
+        # Blank uses every cpu, counted through the executor so a replay builds with the recorded count
+        if self.config["aur_build_jobs"] == "":
+            self.config["aur_build_jobs"] = str(cpu_count())
+
+        # Filesystem backends for root and home, the new install needs the tools for each
+        self.filesystems = {volume: get_filesystem(self.config["filesystem_" + volume], volume,
+                                                   self.config["format_profile_" + volume])
+                            for volume in FS_VOLUMES}
+        pkgs = self.pacman_pkgs.split()
+        for fs in self.filesystems.values():
+            pkgs += [pkg for pkg in fs.packages if pkg not in pkgs]
+        self.pacman_pkgs = " ".join(pkgs)
+
         # Come configs must be set at runtime, rather than in config file
         # Make them blank for now so methods don't have to check for keys
         for key in CONFIG_RUNTIME_SETTINGS:
             self.config[key] = ""
 
-    def full_install(self):
+        # Output of every command is written to a log file per step
+        set_output_log_dir(self.config["log_dir"])
+        # Timing and resource use of every command is traced
+        set_trace_file(self.config["trace_file"])
+
+        # Install progress, saved to state_file after every step
+        self.state = {"started": time.time(), "completed": {}}
+
+        # Passphrases collected up front by collect_input, only ever held in memory
+        self.secrets = {}
+
+        # Exact packages for pacstrap, if they've been locked with install.py lock
+        self.lock = None
+        self.locked_files = []
+        self.load_package_lock()
+        # Download speed of the fastest mirror, for estimating prefetch time
+        self.mirror_throughput = None
+
+        # Packages downloaded by any install on this host are reused by later installs
+        self.pkg_cache = PackageCache(self.config["pkg_cache_dir"],
+                                      parse_size(self.config["pkg_cache_max_size"]))
+        self.pkg_cache.take_snapshot()
+
+        # AUR packages are built once per PKGBUILD and reused by later installs
+        self.aur_cache = AurCache(self.config["aur_cache_dir"])
+        # Compiler caches, so AUR packages that did change don't compile from scratch
+        self.build_cache = BuildCache(self.config["build_cache_dir"],
+                                      {GOMOD: parse_size(self.config["gomodcache_max_size"]),
+                                       GOBUILD: parse_size(self.config["gocache_max_size"]),
+                                       CCACHE: parse_size(self.config["ccache_max_size"])})
+        # Every repo cloned into an install is mirrored here, later installs clone it locally
+        self.git_cache = None
+        if self.config["git_cache_dir"] != "":
+            self.git_cache = GitCache(self.config["git_cache_dir"], int(self.config["git_cache_ttl"]))
+
+    def full_install(self, resume=False, mode="install"):
+        """
+        Runs all steps for mode, independent steps run at the same time
+        mode is install, build-image to build into image_build_dir and write image_file,
+        or deploy to set up the disk from image_file
+        If resume is set, skips the steps a previous run finished
+        """
+        self.state["mode"] = mode
+        if resume:
+            self.load_state()
+        else:
+            self.save_state()
+
+        binds = []
+        if mode == "build-image":
+            self.check_host_dirs(["image_build_dir"])
+            self.config["mount_path"] = self.config["image_build_dir"]
+        if self.config["offline_dir"] != "" and mode != "deploy":
+            self.check_offline_dir()
+            binds.append((self.config["offline_dir"], TARGET_OFFLINE))
+        if mode != "deploy":
+            self.check_host_dirs(CACHE_DIR_SETTINGS)
+            # pacman in the chroot (makepkg, yay) uses the host package cache too
+            make_dirs(self.config["pkg_cache_dir"])
+            make_dirs(self.config["aur_cache_dir"])
+            self.build_cache.prepare()
+            binds += [(self.config["pkg_cache_dir"], TARGET_PKG_CACHE),
+                      (self.config["aur_cache_dir"], TARGET_AUR_CACHE),
+                      (self.config["build_cache_dir"], TARGET_BUILD_CACHE)]
+            if self.git_cache is not None:
+                make_dirs(self.config["git_cache_dir"])
+                binds.append((self.config["git_cache_dir"], TARGET_GIT_CACHE))
+        chroot = ChrootSession(self.config["mount_path"], binds=binds)
+
+        steps = {"install": self.install_steps, "build-image": self.image_steps,
+                 "deploy": self.deploy_steps}[mode]
         try:
+            run_steps(steps(chroot), done=self.state["completed"], on_step_done=self.step_done)
+        finally:
+            chroot.close()
+            print_trace_summary()
+            self.pkg_cache.report()
+            self.aur_cache.report()
+            self.build_cache.report()
+            if self.git_cache is not None:
+                self.git_cache.report()
+
+    def check_host_dirs(self, keys):
+        """
+        Refuses host caches and build dirs on memory backed filesystems, they are lost on reboot
+        and fill up fast. The live ISO's root is an overlay on a small tmpfs, /tmp is a tmpfs
+        """
+        for key in keys:
+            path = self.config[key]
+            if path == "":
+                continue
+            # Dirs that don't exist yet are created on their nearest parent's filesystem
+            while not path_exists(path) and path != os.path.dirname(path):
+                path = os.path.dirname(path)
+            fstype = execute("stat -f -c %T {}".format(path)).stdout.strip()
+            if fstype in MEMORY_FILESYSTEMS:
+                raise Exception("{} {} is on {}, set it to a directory on a disk".format(
+                    key, self.config[key], fstype))
+
+    def step_done(self, step, start, end):
+        """Records a finished step in the install state"""
+        if step.checkpoint:
+            self.state["completed"][step.name] = {"start": start, "end": end}
+            self.save_state()
+
+    def save_state(self):
+        """Writes selected disk, runtime settings and completed steps to the state file"""
+        state_file = self.config["state_file"]
+        self.state["updated"] = time.time()
+        self.state["runtime_settings"] = {key: self.config[key] for key in CONFIG_RUNTIME_SETTINGS}
+
+        # Write then rename so a crash can't leave a half written state file
+        file = open(state_file + ".tmp", "w")
+        file.write(json.dumps(self.state, indent=4))
+        file.close()
+        os.replace(state_file + ".tmp", state_file)
+
+    def load_state(self):
+        """Restores runtime settings and completed steps from the state file"""
+        state_file = self.config["state_file"]
+        if not os.path.isfile(state_file):
+            raise Exception("Cannot resume, {} does not exist".format(state_file))
+
+        mode = self.state["mode"]
+        file = open(state_file, "r")
+        self.state = json.load(file)
+        file.close()
+        if self.state.get("mode", "install") != mode:
+            raise Exception("Cannot resume, {} is from {}, not {}".format(
+                state_file, self.state.get("mode", "install"), mode))
+
+        for key in CONFIG_RUNTIME_SETTINGS:
+            self.config[key] = self.state["runtime_settings"][key]
+
+        log("[*] Resuming install on {}, {} steps already complete".format(
+            self.config["install_disk"], len(self.state["completed"])))
+
+    def reopen_install(self):
+        """Reopens the LUKS container and remounts partitions left by a previous run"""
+        completed = self.state["completed"]
+        mnt_path = self.config["mount_path"]
+        luks_name = self.config["luks_name"]
+
+        if "encrypt_luks_partition" in completed and not path_exists("/dev/mapper/{}".format(luks_name)):
+            log("[*] Reopening LUKS container")
+            luks_partition = self.config["partitions.phys.luks"]
+            execute("cryptsetup open {} {}".format(luks_partition, luks_name),
+                    stdin=self.secrets["luks"] + "\n")
+
+        if "create_lvm_partitions" in completed:
+            log("[*] Activating LVM volumes")
+            execute("vgchange -ay {}".format(self.config["volume_group"]))
+
+        if "mount_partitions" in completed and not is_mount(mnt_path):
+            log("[*] Remounting partitions")
+            self.filesystems["root"].mount(self.config["partitions.lvm.root"], mnt_path)
+            execute("mount {} {}/efi".format(self.config["partitions.phys.efi"], mnt_path))
+            self.filesystems["home"].mount(self.config["partitions.lvm.home"], mnt_path + "/home")
+            execute("swapon {}".format(self.config["partitions.lvm.swap"]))
+
+    def install_steps(self, chroot):
+        """Returns the install steps, what each one depends on and the resources it uses"""
+        return [
+            # Downloads run in the background while the disk is being set up
+            Step("rank_mirrors", self.rank_mirrors, [], ["network"]),
+            Step("prefetch_pkgs", self.prefetch_pkgs, ["rank_mirrors"], ["network"]),
+        ] + self.disk_steps() + [
+            # pacstrap copies the ranked host mirrorlist into the new install
+            Step("pacstrap", self.pacstrap, ["mount_partitions", "prefetch_pkgs"], ["network"]),
+            # Everything below only needs the base system from pacstrap
+            # fstab is generated before the chroot mounts exist so genfstab doesn't pick them up
+            Step("conf_fstab", self.conf_fstab, ["pacstrap"]),
+            Step("conf_tz", self.conf_tz, ["pacstrap"]),
+            Step("conf_network", self.conf_network, ["pacstrap"]),
+            # Set up chroot mounts once for every step that runs commands in the new install
+            Step("chroot_setup", chroot.open, ["conf_fstab"], checkpoint=False),
+            Step("conf_locale", self.conf_locale, ["chroot_setup"], ["chroot"]),
+            Step("conf_users", self.conf_users, ["chroot_setup"], ["chroot"]),
+            Step("install_grub", self.install_grub, ["chroot_setup"], ["chroot"]),
+            Step("enable_services", self.enable_services, ["chroot_setup"], ["chroot"]),
+        ] + self.user_steps(chroot, "conf_users")
+
+    def image_steps(self, chroot):
+        """
+        Returns the steps that build a golden image, everything that's the same on every machine
+        Hostname, fstab, passwords and grub depend on the machine and its disk, deploy does those
+        """
+        return [
+            Step("rank_mirrors", self.rank_mirrors, [], ["network"]),
+            Step("prefetch_pkgs", self.prefetch_pkgs, ["rank_mirrors"], ["network"]),
+            Step("prepare_image_root", self.prepare_image_root, [], ["disk"]),
+            Step("pacstrap", self.pacstrap, ["prepare_image_root", "prefetch_pkgs"], ["network"]),
+            Step("conf_tz", self.conf_tz, ["pacstrap"]),
+            Step("chroot_setup", chroot.open, ["pacstrap"], checkpoint=False),
+            Step("conf_locale", self.conf_locale, ["chroot_setup"], ["chroot"]),
+            Step("create_users", self.create_users, ["chroot_setup"], ["chroot"]),
+            Step("enable_services", self.enable_services, ["chroot_setup"], ["chroot"]),
+        ] + self.user_steps(chroot, "create_users") + [
+            # The image must not contain the bind mounted caches
+            Step("chroot_teardown", chroot.close,
+                 ["conf_tz", "conf_locale", "enable_services", "remove_makepkg_profile", "remove_offline_repo",
+                  "remove_install_sudo", "tidy_pkg_cache", "tidy_build_cache"], checkpoint=False),
+            Step("write_image", self.write_image, ["chroot_teardown"], ["disk"]),
+        ]
+
+    def deploy_steps(self, chroot):
+        """Returns the steps that install a golden image, then set up what's specific to this machine"""
+        return self.disk_steps() + [
+            Step("extract_image", self.extract_image, ["mount_partitions"], ["disk"]),
+            Step("conf_fstab", self.conf_fstab, ["extract_image"]),
+            Step("conf_network", self.conf_network, ["extract_image"]),
+            Step("chroot_setup", chroot.open, ["conf_fstab"], checkpoint=False),
+            # The sudo user is in the image already
+            Step("conf_users", self.set_passwords, ["chroot_setup"], ["chroot"]),
+            Step("install_grub", self.install_grub, ["chroot_setup"], ["chroot"]),
+        ]
+
+    def disk_steps(self):
+        """Returns the steps that ask for input, then partition, encrypt, format and mount the disk"""
+        return [
+            # All prompts happen here, nothing after this needs the console
+            Step("collect_input", self.collect_input, [], ["tty"], checkpoint=False),
+            # Only does anything when resuming an install
+            Step("reopen_install", self.reopen_install, ["collect_input"], ["disk"], checkpoint=False),
+            Step("partition_disk_phys", self.partition_disk_phys, ["reopen_install"], ["disk"]),
+            Step("encrypt_luks_partition", self.encrypt_luks_partition, ["partition_disk_phys"], ["disk"]),
+            Step("create_lvm_partitions", self.create_lvm_partitions, ["encrypt_luks_partition"], ["disk"]),
+            Step("format_partitions", self.format_partitions, ["create_lvm_partitions"], ["disk"]),
+            Step("mount_partitions", self.mount_partitions, ["format_partitions"], ["disk"]),
+        ]
+
+    def user_steps(self, chroot, users_step):
+        """Returns the steps that run as the sudo user once users_step has created it"""
+        return [
+            # The build tmpfs goes away with the chroot mounts, so this runs again on resume
+            Step("makepkg_profile", lambda: self.makepkg_profile(chroot), ["chroot_setup", users_step], ["chroot"],
+                 checkpoint=False),
+            # Only does anything for offline installs
+            Step("offline_repo", self.offline_repo, ["chroot_setup"], ["chroot"], checkpoint=False),
+            # AUR builds, ohmyzsh and dotfiles need the sudo user
+            Step("install_yay", self.install_yay, [users_step, "makepkg_profile", "offline_repo"],
+                 ["chroot", "network"]),
+            Step("install_yay_pkgs", self.install_yay_pkgs, ["install_yay"], ["chroot", "network"]),
+            Step("remove_makepkg_profile", self.remove_makepkg_profile, ["install_yay_pkgs"], ["chroot"]),
+            Step("remove_offline_repo", self.remove_offline_repo, ["install_yay_pkgs"], ["chroot"]),
+            Step("install_ohmyzsh", self.install_ohmyzsh, [users_step], ["chroot", "network"]),
+            Step("configure", self.configure, ["install_ohmyzsh"], ["chroot", "network"]),
+            Step("remove_install_sudo", self.remove_install_sudo,
+                 ["install_yay_pkgs", "configure"], ["chroot"]),
+            Step("tidy_pkg_cache", self.tidy_pkg_cache, ["install_yay_pkgs"], checkpoint=False),
+            Step("tidy_build_cache", self.tidy_build_cache, ["install_yay_pkgs"], ["chroot"], checkpoint=False),
+        ]
+
+    def collect_input(self):
+        """
+        Asks for everything the install needs from the user, so the remaining steps run unattended
+        Disk choice goes in config, passphrases are kept in memory and fed to commands over stdin
+        """
+        completed = self.state["completed"]
+
+        # A resumed install already has its disk
+        if self.config["install_disk"] == "":
             self.select_disk()
-            self.partition_disk_phys()
-            self.encrypt_luks_partition()
-            self.create_lvm_partitions()
-            self.format_partitions()
-            self.mount_partitions()
-            self.pacstrap()
-            self.conf_fstab()
-            self.conf_tz()
-            self.conf_locale()
-            self.conf_network()
-            self.conf_users()
-            self.install_grub()
-            self.enable_services()
-            self.install_yay()
-            self.install_yay_pkgs()
-            self.install_ohmyzsh()
-            self.configure()
-        except Exception as e:
-            raise e
+
+        log("[*] Collecting passphrases, the rest of the install runs unattended")
+        self.secrets["luks"] = prompt_secret("LUKS passphrase: ")
+        if "conf_users" not in completed:
+            self.secrets["root"] = prompt_secret("Root password: ")
+            self.secrets["user"] = prompt_secret("Password for {}: ".format(self.config["sudo_user"]))
 
     def select_disk(self):
         """Prompt user to select installation disk""" 
@@ -125,6 +554,9 @@ class Installer:
             if line[TYPE_INDEX] == "disk":
                 disks.append((line[NAME_INDEX], line[SIZE_INDEX]))
 
+        if not disks:
+            raise Exception("No disks found to install to")
+
         # Display available disks and select disk to install to
         for i in range(len(disks)): 
             print("{}\t{}".format(disks[i][0], disks[i][1]))
@@ -132,7 +564,7 @@ class Installer:
         valid = False
         install_disk = ""
         while not valid:
-            install_disk = input("Please select a disk to install to: ")
+            install_disk = prompt("Please select a disk to install to: ")
             for disk in disks:
                 if install_disk == disk[0]:
                     valid = True
@@ -150,7 +582,7 @@ class Installer:
         """Creates 2 partitions, efi and LUKS"""    
         disk = self.config["install_disk"]
     
-        if not os.path.exists(disk):
+        if not path_exists(disk):
             raise Exception("Disk not found - {}".format(disk))
 
         log("[*] Clearing any existing partition table")
@@ -165,17 +597,20 @@ class Installer:
         luks_partition = self.config["partitions.phys.luks"]
         luks_name = self.config["luks_name"]
 
-        if not os.path.exists(luks_partition):
+        if not path_exists(luks_partition):
             raise Exception("Partition not found - {}".format(luks_partition))
         if luks_name == "":
             raise Exception("Luks name not set")
 
+        # cryptsetup reads the passphrase from the first line of stdin when it isn't a tty
+        passphrase = self.secrets["luks"] + "\n"
+
         log("[*] Encrpyting {}".format(luks_partition))
-        # Use luks1 for grub compatability
-        execute("cryptsetup luksFormat --type luks1 {}".format(luks_partition), interactive=True)
+        # Use luks1 for grub compatability, -q skips the confirmation prompt
+        execute("cryptsetup -q luksFormat --type luks1 {}".format(luks_partition), stdin=passphrase)
 
         log("[*] Opening LUKS container to partition with LVM")
-        execute("cryptsetup open {} {}".format(luks_partition, luks_name), interactive=True)
+        execute("cryptsetup open {} {}".format(luks_partition, luks_name), stdin=passphrase)
 
     def create_lvm_partitions(self):
         """Creates LVM partitions, requires an open LUKS container"""
@@ -184,7 +619,7 @@ class Installer:
         vol_grp   = self.config["volume_group"]
         luks_path = "/dev/mapper/{}".format(self.config["luks_name"])
 
-        if not os.path.exists(luks_path):
+        if not path_exists(luks_path):
             raise Exception("{} does not exist".format(luks_path))
 
         log("[*] Creating LVM volumes")
@@ -213,10 +648,26 @@ class Installer:
 
         log("[*] Formatting partitions")
 
-        execute("mkfs.ext4 {}".format(root))
-        execute("mkfs.ext4 {}".format(home))
-        execute("mkswap {}".format(swap))
-        execute("mkfs.fat -F32 {}".format(efi))
+        # Each volume is a separate device, so they're formatted at the same time
+        formats = [(root, self.filesystems["root"].format), (home, self.filesystems["home"].format),
+                   (swap, lambda device: (execute("mkswap {}".format(device)).returncode, "swap")),
+                   (efi, lambda device: (execute("mkfs.fat -F32 {}".format(device)).returncode, "fat32"))]
+
+        def format_device(device_format):
+            device, format_func = device_format
+            start = time.time()
+            returncode, settings = format_func(device)
+            return device, settings, returncode, time.time() - start
+
+        failures = []
+        for device, settings, returncode, elapsed in parallel_map(format_device, formats, len(formats)):
+            if returncode != 0:
+                log("[!] Formatting {} failed after {:.1f}s".format(device, elapsed))
+                failures.append(device)
+            else:
+                log("[+] Formatted {} in {:.1f}s ({})".format(device, elapsed, settings))
+        if failures:
+            raise Exception("Failed to format {}".format(", ".join(failures)))
 
     def mount_partitions(self):
         """Mount efi, home, and root. swapon swap"""
@@ -233,26 +684,307 @@ class Installer:
 
         log("[*] Mounting partitions")
     
-        execute("mount {} {}".format(root, mnt_path))
+        if self.filesystems["root"].mount(root, mnt_path) != 0:
+            raise Exception("Failed to mount {} on {}".format(root, mnt_path))
         execute("mkdir {}/efi".format(mnt_path))
         execute("mkdir {}/home".format(mnt_path))
         execute("mount {} {}/efi".format(efi, mnt_path))
-        execute("mount {} {}/home".format(home, mnt_path))
+        if self.filesystems["home"].mount(home, mnt_path + "/home") != 0:
+            raise Exception("Failed to mount {} on {}/home".format(home, mnt_path))
         execute("swapon {}".format(swap))
 
+    def prepare_image_root(self):
+        """Creates the directory the image is built in, which must be empty"""
+        image_root = self.config["mount_path"]
+        if os.path.isdir(image_root) and os.listdir(image_root):
+            raise Exception("{} is not empty, remove it or set image_build_dir".format(image_root))
+        make_dirs(image_root)
+
+    def write_image(self):
+        """Archives the built system into image_file with multithreaded zstd"""
+        image_root = self.config["mount_path"]
+        image_file = self.config["image_file"]
+        excludes = " ".join("--exclude={}".format(path) for path in IMAGE_EXCLUDES)
+
+        log("[*] Writing image {}".format(image_file))
+        start = time.time()
+        proc = execute("tar --use-compress-program=pzstd {} {} -cpf {}.tmp -C {} .".format(
+            IMAGE_TAR_ARGS, excludes, image_file, image_root))
+        if proc.returncode != 0:
+            raise Exception("Failed to write image {}".format(image_file))
+        # Rename so a half written image is never deployed
+        execute("mv -T {}.tmp {}".format(image_file, image_file))
+        if os.path.isfile(image_file):
+            log("[+] Wrote {:.1f} MB image in {:.1f}s".format(os.path.getsize(image_file) / MB,
+                                                             time.time() - start))
+
+    def extract_image(self):
+        """
+        Extracts image_file (a path or URL) onto the mounted root and home volumes
+        Reading, decompressing and extracting run at the same time so neither the cpu nor the disk waits
+        """
+        mnt_path = self.config["mount_path"]
+        image_file = self.config["image_file"]
+        if "://" not in image_file and not path_exists(image_file):
+            raise Exception("Image not found - {}".format(image_file))
+
+        def progress(stats):
+            rate = stats["fed"][0] / MB / stats["elapsed"]
+            total = " of {:.0f}".format(stats["total"] / MB) if stats["total"] else ""
+            log("[*] Read {:.0f}{} MB ({:.1f} MB/s), extracted {:.0f} MB".format(
+                stats["fed"][0] / MB, total, rate, stats["fed"][-1] / MB))
+
+        log("[*] Extracting image {}".format(image_file))
+        start = time.time()
+        read_bytes = stream(image_file, ["zstd -dc", "tar {} -xp -C {}".format(IMAGE_TAR_ARGS, mnt_path)],
+                            on_progress=progress)
+        elapsed = time.time() - start
+        log("[+] Extracted {:.1f} MB image in {:.1f}s ({:.1f} MB/s)".format(
+            read_bytes / MB, elapsed, read_bytes / MB / elapsed if elapsed else 0))
+
+    def rank_mirrors(self):
+        """
+        Probes candidate mirrors and writes the fastest to the host mirrorlist
+        Uses mirror_candidates, or every server in the original mirrorlist if that's blank
+        (kept as mirrorlist.orig once it's been overwritten). Rankings are reused for mirror_ttl seconds
+        """
+        if self.config["offline_dir"] != "":
+            log("[*] Offline install, not ranking mirrors")
+            return
+
+        proxy = ""
+        if self.config["cache_proxy"] != "":
+            proxy = "{}/$repo/os/$arch".format(self.config["cache_proxy"].rstrip("/"))
+        servers = self.config["mirror_candidates"].split() or mirrors.candidate_servers(exclude=[proxy])
+        count = int(self.config["mirror_count"])
+
+        if isinstance(get_executor(), DryRunExecutor):
+            # Probes are real network traffic, a dry run keeps the candidates in order
+            log("[*] Not probing mirrors in a dry run")
+            servers = servers[:count]
+        else:
+            ranked = self.probe_mirrors(servers)
+            if ranked is None:
+                return
+            if ranked:
+                self.mirror_throughput = ranked[0]["throughput"]
+            for result in ranked[:count]:
+                log("[+] {:>8.2f} MB/s {:>6.0f} ms  {}".format(result["throughput"] / MB,
+                                                            result["latency"] * 1000, result["server"]))
+            servers = [result["server"] for result in ranked[:count]]
+
+        # A cache proxy on the imaging station goes first, the ranked mirrors are a fallback
+        if proxy != "":
+            servers.insert(0, proxy)
+        mirrors.write_mirrorlist(servers)
+
+    def probe_mirrors(self, servers):
+        """Ranks servers, reusing a ranking newer than mirror_ttl. None if none could be reached"""
+        cache_file = self.config["mirror_cache"]
+        ranked = mirrors.load_ranking(cache_file, servers, int(self.config["mirror_ttl"]))
+        if ranked is not None:
+            log("[*] Using cached mirror ranking")
+            return ranked
+
+        log("[*] Ranking {} mirrors".format(len(servers)))
+        ranked = mirrors.rank_mirrors(servers, int(self.config["mirror_probe_bytes"]),
+                                      float(self.config["mirror_probe_timeout"]))
+        if not ranked and self.config["cache_proxy"] == "":
+            log("[!] No mirrors could be reached, keeping current mirrorlist")
+            return None
+        mirrors.save_ranking(cache_file, servers, ranked)
+        return ranked
+
+    def serve_cache(self):
+        """Runs a caching mirror for installs on other machines, see cache_proxy"""
+        # Commented out servers in the mirrorlist are disabled, the proxy mustn't use them
+        upstream = self.config["cache_proxy_upstream"].split() or mirrors.read_mirrorlist(active_only=True)
+        cache_proxy.serve_cache(int(self.config["cache_proxy_port"]), self.config["cache_proxy_dir"],
+                                parse_size(self.config["cache_proxy_max_size"]), upstream)
+
+    def load_package_lock(self):
+        """
+        Loads lock_file if there is one and it still matches Pacman.Pkgs
+        Checks the locked packages fit on the root partition before anything is touched
+        """
+        lock_file = self.config["lock_file"]
+        if not os.path.isfile(lock_file):
+            return
+
+        lock = pkg_lock.load_lock(lock_file)
+        if lock["requested"] != sorted(self.pacman_pkgs.split()):
+            log("[!] {} doesn't match Pacman.Pkgs, ignoring it. Run install.py lock again".format(lock_file))
+            return
+
+        root_size = parse_size(self.config["root_size"])
+        if lock["installed_size"] > root_size:
+            raise Exception("Locked packages need {:.1f} GB but root_size is only {:.1f} GB".format(
+                lock["installed_size"] / SIZE_UNITS["G"], root_size / SIZE_UNITS["G"]))
+
+        self.lock = lock
+        log("[*] Using {}: {} packages, {:.1f} MB download, {:.1f} MB installed".format(
+            lock_file, len(lock["packages"]), lock["download_size"] / MB, lock["installed_size"] / MB))
+
+    def lock_packages(self):
+        """Resolves the exact packages Pacman.Pkgs installs and writes them to lock_file"""
+        db_path = self.config["pkg_cache_dir"] + PREFETCH_DB_SUFFIX
+        make_dirs(db_path)
+
+        log("[*] Syncing package databases")
+        proc = execute("pacman -Sy --noprogressbar --dbpath {}".format(db_path))
+        if proc.returncode != 0:
+            raise Exception("Failed to sync package databases")
+
+        lock = pkg_lock.resolve_lock(db_path, self.pacman_pkgs.split())
+        pkg_lock.save_lock(lock, self.config["lock_file"])
+        log("[+] Locked {} packages to {}, {:.1f} MB download, {:.1f} MB installed".format(
+            len(lock["packages"]), self.config["lock_file"], lock["download_size"] / MB,
+            lock["installed_size"] / MB))
+
+    def prefetch_pkgs(self):
+        """
+        Downloads pacman packages and all their dependencies to the host package cache
+        A failed prefetch isn't fatal, pacstrap downloads whatever is missing
+        """
+        cache_dir = self.config["pkg_cache_dir"]
+        packages = self.pacman_pkgs
+
+        if self.config["offline_dir"] != "":
+            log("[*] Offline install, packages come from the offline repo")
+            return
+        if self.lock is not None:
+            self.prefetch_locked()
+            return
+
+        # An empty pacman db means nothing counts as installed, so the full dependency
+        # closure is downloaded rather than just what the live system is missing
+        # It's kept next to the cache so later runs only sync databases that changed
+        db_path = cache_dir + PREFETCH_DB_SUFFIX
+        make_dirs(cache_dir)
+        make_dirs(db_path)
+
+        log("[*] Prefetching packages to {}".format(cache_dir))
+        proc = execute("pacman -Syw --noconfirm --noprogressbar --dbpath {} --cachedir {} {}".format(
+            db_path, cache_dir, packages))
+        if proc.returncode != 0:
+            log("[!] Package prefetch failed, pacstrap will download packages itself")
+        else:
+            log("[+] Package prefetch complete")
+
+    def prefetch_locked(self):
+        """Downloads exactly the locked packages, no database sync needed"""
+        cache_dir = self.config["pkg_cache_dir"]
+        make_dirs(cache_dir)
+
+        missing = pkg_lock.missing_packages(self.lock, cache_dir)
+        download = sum(pkg["csize"] for pkg in missing)
+        eta = ""
+        if self.mirror_throughput:
+            eta = ", about {:.0f}s".format(download / self.mirror_throughput)
+        log("[*] Prefetching {} locked packages, {:.1f} MB{}".format(len(missing), download / MB, eta))
+
+        # Checksumming every cached package is slow, so it's only done once
+        missing = pkg_lock.fetch_locked(self.lock, cache_dir, mirrors.read_mirrorlist(), missing)
+        if missing:
+            log("[!] {} locked packages could not be fetched, pacstrap will resolve packages itself".format(
+                len(missing)))
+            return
+
+        self.locked_files = [os.path.join(cache_dir, pkg["filename"]) for pkg in self.lock["packages"]]
+        log("[+] Package prefetch complete")
+
+    def tidy_pkg_cache(self):
+        """Counts package cache hits for this install, then evicts to keep the cache under its size limit"""
+        mnt_path = self.config["mount_path"]
+
+        # Collect every line, a full install has more packages than execute keeps
+        lines = []
+        execute("pacman --dbpath {}/var/lib/pacman -Q".format(mnt_path), on_output=lines.append)
+        installed = [tuple(line.split()) for line in lines if len(line.split()) == 2]
+        self.pkg_cache.count_hits(installed)
+        self.pkg_cache.evict()
+
+    def tidy_build_cache(self):
+        """Counts compiler cache hits for this install, then evicts to keep the caches under their size limits"""
+        mnt_path = self.config["mount_path"]
+        su = "su {}".format(self.config["sudo_user"])
+
+        ccache_stats = ""
+        if path_exists("{}/usr/bin/ccache".format(mnt_path)):
+            ccache = self.build_cache.ccache_command("/" + TARGET_BUILD_CACHE, "--print-stats")
+            ccache_stats = execute(su, stdin=ccache, chroot_dir=mnt_path).stdout
+        self.build_cache.count_hits(ccache_stats)
+        self.build_cache.evict()
+
     def pacstrap(self):
         """Install arch linux and any specified packages (Pacman not AUR)"""
         mnt_path = self.config["mount_path"]
+        cache_dir = self.config["pkg_cache_dir"]
         packages = self.pacman_pkgs
         log("[*] Running pacstrap to install base system")
-        execute("pacstrap {} {}".format(mnt_path, packages), interactive=True)
+        if self.lock is not None and not self.locked_files and "prefetch_pkgs" in self.state["completed"]:
+            # A resumed install skips prefetch_pkgs, the locked files it fetched are still cached
+            locked_files = [os.path.join(cache_dir, pkg["filename"]) for pkg in self.lock["packages"]]
+            if all(path_exists(path) for path in locked_files):
+                self.locked_files = locked_files
+        if self.locked_files:
+            # Install the prefetched locked packages as files, pacman doesn't sync or resolve anything
+            execute("pacstrap -U {} {}".format(mnt_path, " ".join(self.locked_files)), interactive=True)
+            self.copy_sync_dbs()
+            return
+        if self.config["offline_dir"] != "":
+            # The offline repo replaces every repo in the hosts pacman.conf
+            repo_dir = os.path.join(self.config["offline_dir"], OFFLINE_REPO)
+            pacman_conf = os.path.join(tempfile.mkdtemp(), "pacman.conf")
+            write_file(OFFLINE_PACMAN_CONF_TEMPLATE.format(OFFLINE_REPO_NAME, repo_dir), pacman_conf)
+            execute("pacstrap -C {} {} {} --cachedir={}".format(pacman_conf, mnt_path, packages, cache_dir),
+                    interactive=True)
+            return
+        # Extra args are passed to pacman, packages in the prefetch cache aren't downloaded again
+        execute("pacstrap {} {} --cachedir={}".format(mnt_path, packages, cache_dir), interactive=True)
  
+    def copy_sync_dbs(self):
+        """
+        pacstrap -U leaves the new install without sync databases, so later pacman -S and
+        makepkg -s would find nothing. Copies the ones the lock was resolved from, or syncs
+        """
+        mnt_path = self.config["mount_path"]
+        sync_dir = os.path.join(self.config["pkg_cache_dir"] + PREFETCH_DB_SUFFIX, "sync")
+        target = "{}/var/lib/pacman/sync".format(mnt_path)
+        dbs = []
+        if os.path.isdir(sync_dir):
+            dbs = [os.path.join(sync_dir, name) for name in sorted(os.listdir(sync_dir)) if name.endswith(".db")]
+
+        make_dirs(target)
+        if dbs:
+            log("[*] Copying sync databases from {}".format(sync_dir))
+            proc = execute("cp {} {}".format(" ".join(dbs), target))
+        else:
+            # The lock was made on another host
+            log("[*] Syncing package databases in new install")
+            proc = execute("pacman --root {} -Sy".format(mnt_path))
+        if proc.returncode != 0:
+            raise Exception("Failed to set up sync databases in {}".format(target))
+
     def conf_fstab(self):
         """Creates fstab on new install"""
         mnt_path = self.config["mount_path"]
         fstab_file = "{}/etc/fstab".format(mnt_path)
         log("[*] Configuring fstab")
         execute("genfstab -U {}".format(mnt_path), outfile=fstab_file)
+
+        # genfstab copies the install's mount options, root and home get their runtime ones instead
+        backends = {FS_MOUNT_POINTS[volume]: fs for volume, fs in self.filesystems.items()}
+        lines = []
+        for line in read_file(fstab_file).splitlines():
+            fields = line.split()
+            if len(fields) == 6 and not line.startswith("#") and fields[1] in backends:
+                fs = backends[fields[1]]
+                fields[3] = fs.fstab_options()
+                fields[5] = str(fs.fsck_pass())
+                line = "\t".join(fields)
+            lines.append(line)
+        write_file("\n".join(lines) + "\n", fstab_file)
  
     def conf_tz(self):
         """Links specified timzone file to /etc/localtime"""
@@ -260,7 +992,8 @@ class Installer:
         region = self.config["tz.region"]
         city = self.config["tz.city"]
 
-        tz_file = "{}/usr/share/zoneinfo/{}/{}".format(mnt_path, region, city)
+        # The link is followed in the new install, so its target mustn't include mount_path
+        tz_file = "/usr/share/zoneinfo/{}/{}".format(region, city)
         localtime_file = "{}/etc/localtime".format(mnt_path)
 
         log("[*] Setting timezone")
@@ -288,20 +1021,44 @@ class Installer:
         write_file(hosts, "{}/etc/hosts".format(mnt_path))
 
     def conf_users(self):
-        """Prompts for root password, edits sudoers file, creates sudo user"""
+        """Creates sudo user and sets passwords"""
+        self.create_users()
+        self.set_passwords()
+
+    def create_users(self):
+        """Creates sudo user without a password, edits sudoers file"""
         mnt_path = self.config["mount_path"]
         sudo_user = self.config["sudo_user"]
 
         log("[*] Configuring users")
-        log("[+] Set root password")
-        execute("passwd root", chroot_dir=mnt_path, interactive=True)
-
         log("[+] Creating sudo user")
         execute("useradd -mG wheel {}".format(sudo_user), chroot_dir=mnt_path)
-        execute("passwd {}".format(sudo_user), chroot_dir=mnt_path)
+
         sudoers = "root ALL=(ALL:ALL) ALL\n" + "%wheel ALL=(ALL:ALL) ALL\n" + "@includedir /etc/sudoers.d"
         write_file(sudoers, "{}/etc/sudoers".format(mnt_path))
 
+        # makepkg and yay call sudo, let them run without a password prompt until the install is done
+        make_dirs("{}/etc/sudoers.d".format(mnt_path))
+        install_sudo = "{} ALL=(ALL:ALL) NOPASSWD: ALL\n".format(sudo_user)
+        write_file(install_sudo, "{}{}".format(mnt_path, INSTALL_SUDOERS))
+
+    def set_passwords(self):
+        """Sets root and sudo user passwords"""
+        mnt_path = self.config["mount_path"]
+        sudo_user = self.config["sudo_user"]
+
+        log("[+] Setting passwords")
+        passwords = "root:{}\n{}:{}\n".format(self.secrets["root"], sudo_user, self.secrets["user"])
+        execute("chpasswd", stdin=passwords, chroot_dir=mnt_path)
+
+    def remove_install_sudo(self):
+        """Removes the passwordless sudo rule used during the install"""
+        mnt_path = self.config["mount_path"]
+        log("[*] Removing passwordless sudo for install")
+        sudoers_file = "{}{}".format(mnt_path, INSTALL_SUDOERS)
+        if path_exists(sudoers_file):
+            remove_file(sudoers_file)
+
     def install_grub(self):
         """
         Creates master encryption key foor grub to boot with
@@ -318,7 +1075,8 @@ class Installer:
         print(key_path)
         execute("dd bs=512 count=4 if=/dev/random of={} iflag=fullblock".format(key_path))
         execute("chmod 000 {}".format(key_path))
-        execute("cryptsetup -v luksAddKey {} {}".format(luks_partition, key_path), interactive=True)
+        execute("cryptsetup -v luksAddKey {} {}".format(luks_partition, key_path),
+                stdin=self.secrets["luks"] + "\n")
     
         log("[*] Configuring intram with encrypted boot")
         initram = "{}\nFILES=(/root/{}.keyfile)".format(initram_hooks, luks_name)
@@ -344,6 +1102,110 @@ class Installer:
         for serv in services:
             execute("systemctl enable {}".format(serv), chroot_dir=mnt_path)
 
+    def makepkg_profile(self, chroot):
+        """
+        Writes the makepkg config AUR builds use during the install: make uses every cpu,
+        packages are built on a tmpfs sized from available memory and aren't compressed
+        (makepkg_pkgext), zstd uses every cpu if compression is turned back on
+        """
+        mnt_path = self.config["mount_path"]
+        jobs = int(self.config["aur_build_jobs"])
+        # A resumed install that already removed the profile must not leave a new one behind
+        if "remove_makepkg_profile" in self.state["completed"]:
+            return
+
+        # makepkg only reads drop-ins next to MAKEPKG_CONF, so the stock ones (eg. rust.conf) are sourced here
+        # MAKE_JOBS lets parallel builds split the cpus between them
+        profile = ["source /etc/makepkg.conf",
+                   'for conf in /etc/makepkg.conf.d/*.conf; do if [ -f "$conf" ]; then source "$conf"; fi; done',
+                   'MAKEFLAGS="-j${{MAKE_JOBS:-{}}}"'.format(jobs),
+                   "PKGEXT='{}'".format(self.config["makepkg_pkgext"]),
+                   "COMPRESSZST=(zstd -c -T0 -)"]
+
+        tmpfs_size = int(mem_available() * MAKEPKG_TMPFS_RATIO)
+        if tmpfs_size >= parse_size(MAKEPKG_TMPFS_MIN):
+            chroot.mount("tmpfs", MAKEPKG_BUILDDIR, "-t tmpfs -o size={},mode=1777".format(tmpfs_size))
+            profile.append("BUILDDIR=/{}".format(MAKEPKG_BUILDDIR))
+            log("[+] Building AUR packages on a {}M tmpfs".format(tmpfs_size // MB))
+        else:
+            log("[!] Not enough memory for a build tmpfs, building AUR packages on disk")
+
+        # Go and ccache caches shared with other installs, only writable by the build user
+        execute(self.build_cache.chown_command("/" + TARGET_BUILD_CACHE, self.config["sudo_user"]),
+                chroot_dir=mnt_path)
+        profile += self.build_cache.profile("/" + TARGET_BUILD_CACHE)
+        self.build_cache.take_snapshot()
+
+        log("[*] Writing makepkg profile {}".format(MAKEPKG_PROFILE))
+        write_file("\n".join(profile) + "\n", mnt_path + MAKEPKG_PROFILE)
+
+    def remove_makepkg_profile(self):
+        """Removes the install makepkg config, yay uses the stock one from here on"""
+        profile = self.config["mount_path"] + MAKEPKG_PROFILE
+        if path_exists(profile):
+            remove_file(profile)
+
+    def check_offline_dir(self):
+        """Checks offline_dir has everything an offline install needs"""
+        offline_dir = self.config["offline_dir"]
+        validate_file_paths([os.path.join(offline_dir, path) for path in
+                             [os.path.join(OFFLINE_REPO, OFFLINE_REPO_NAME + ".db"), OFFLINE_AUR,
+                              OFFLINE_DOTFILES, OFFLINE_OHMYZSH, OFFLINE_OHMYZSH_INSTALL]])
+
+    def offline_repo(self):
+        """Points pacman in the new install at the offline repo for installing yay packages"""
+        mnt_path = self.config["mount_path"]
+        if self.config["offline_dir"] == "":
+            return
+        # A resumed install that already removed the repo must not leave it configured again
+        if "remove_offline_repo" in self.state["completed"]:
+            return
+
+        log("[*] Using offline repo in new install")
+        repo_dir = "/{}/{}".format(TARGET_OFFLINE, OFFLINE_REPO)
+        write_file(OFFLINE_PACMAN_CONF_TEMPLATE.format(OFFLINE_REPO_NAME, repo_dir),
+                   mnt_path + OFFLINE_PACMAN_CONF)
+        execute("{} -Sy".format(self.pacman()), chroot_dir=mnt_path)
+
+    def remove_offline_repo(self):
+        """Removes the offline pacman config and its sync database, the install uses its mirrors from here on"""
+        mnt_path = self.config["mount_path"]
+        if self.config["offline_dir"] == "":
+            return
+
+        for path in [OFFLINE_PACMAN_CONF, "/var/lib/pacman/sync/{}.db".format(OFFLINE_REPO_NAME)]:
+            if path_exists(mnt_path + path):
+                remove_file(mnt_path + path)
+
+    def pacman(self):
+        """pacman command for the new install, only using the offline repo for offline installs"""
+        if self.config["offline_dir"] != "":
+            return "pacman --config {}".format(OFFLINE_PACMAN_CONF)
+        return "pacman"
+
+    def offline_aur_pkgs(self):
+        """Prebuilt AUR packages in offline_dir, package name to path in the new install"""
+        aur_dir = os.path.join(self.config["offline_dir"], OFFLINE_AUR)
+        pkgs = {}
+        for name in sorted(os.listdir(aur_dir)) if os.path.isdir(aur_dir) else []:
+            match = PKG_FILE.match(name)
+            if match is not None:
+                pkgs[match.group("name")] = "/{}/{}/{}".format(TARGET_OFFLINE, OFFLINE_AUR, name)
+        return pkgs
+
+    def install_offline_pkgs(self, pkgs):
+        """Installs pkgs from the prebuilt AUR packages, or the offline repo if they're not AUR packages"""
+        mnt_path = self.config["mount_path"]
+        aur_pkgs = self.offline_aur_pkgs()
+        repo_pkgs = [pkg for pkg in pkgs if pkg not in aur_pkgs]
+        pkg_files = [aur_pkgs[pkg] for pkg in pkgs if pkg in aur_pkgs]
+
+        if repo_pkgs:
+            execute("{} -S --needed --noconfirm {}".format(self.pacman(), " ".join(repo_pkgs)), chroot_dir=mnt_path)
+        if pkg_files:
+            # Repo dependencies of AUR packages come from the offline repo
+            execute("{} -U --noconfirm {}".format(self.pacman(), " ".join(pkg_files)), chroot_dir=mnt_path)
+
     # Use of arch-chroot is hacky and inconsistent :(
     def install_yay(self):
         """Clones yay from AUR and installs on guest system"""
@@ -353,26 +1215,230 @@ class Installer:
         # makepkg must be run as non-root user and from dir of pkg being installed
         yay_dir = "/home/{}/yay".format(sudo_user)
 
-        su = "su {}".format(sudo_user)
-        clone_repo = "git clone {} {}".format(YAY_REPO, yay_dir)
-        build_yay = "cd {}; makepkg -si --noconfirm".format(yay_dir)
+        if self.config["offline_dir"] != "":
+            log("[*] Installing prebuilt yay")
+            if "yay" not in self.offline_aur_pkgs():
+                raise Exception("yay missing from {}".format(os.path.join(self.config["offline_dir"], OFFLINE_AUR)))
+            self.install_offline_pkgs(["yay"])
+            return
 
         log("[*] Cloning and installing yay")
-        execute(su, stdin=clone_repo, chroot_dir=mnt_path)
-        execute(su, stdin=build_yay, chroot_dir=mnt_path, interactive=True)
+        if not self.clone_aur_pkg(YAY_REPO, yay_dir, self.config["yay_ref"]):
+            raise Exception("Failed to clone yay")
+        pkg_files = self.build_aur_pkg(YAY_REPO, yay_dir, jobs=int(self.config["aur_build_jobs"]))
+        if not pkg_files:
+            raise Exception("Failed to build yay")
+        execute("pacman -U --noconfirm {}".format(" ".join(pkg_files)), chroot_dir=mnt_path)
+        self.remove_built_pkgs([yay_dir])
 
     def install_yay_pkgs(self):
-        """Installs packages using yay"""
-        mnt_path =self.config["mount_path"]
+        """
+        Installs Yay.Pkgs, AUR packages come from the build cache, anything else from the repos
+        Repo dependencies of every AUR package are installed in one transaction first, then
+        AUR packages that don't depend on each other are built at the same time, splitting
+        aur_build_jobs cpus between them. Results are installed in a single transaction
+        """
+        mnt_path = self.config["mount_path"]
         sudo_user = self.config["sudo_user"]
-        yay_pkgs = self.yay_pkgs
+        jobs = int(self.config["aur_build_jobs"])
+        pkgs = self.yay_pkgs.split()
+        if not pkgs:
+            return
+        if self.config["offline_dir"] != "":
+            log("[*] Installing yay packages from offline_dir")
+            self.install_offline_pkgs(pkgs)
+            return
+
+        log("[*] Cloning yay packages")
+        pkg_dirs = {pkg: "/home/{}/aur/{}".format(sudo_user, pkg) for pkg in pkgs}
+        in_aur = parallel_map(lambda pkg: self.clone_aur_pkg(AUR_REPO.format(pkg), pkg_dirs[pkg]), pkgs, len(pkgs))
+        in_aur = dict(zip(pkgs, in_aur))
+
+        aur_pkgs = {pkg: read_srcinfo("{}{}/.SRCINFO".format(mnt_path, pkg_dirs[pkg]))
+                    for pkg in pkgs if in_aur[pkg]}
+        repo_pkgs = [pkg for pkg in pkgs if not in_aur[pkg]]
+        aur_names = set()
+        for pkg, (names, _) in aur_pkgs.items():
+            aur_names |= names | {pkg}
+        repo_deps = set()
+        for names, deps in aur_pkgs.values():
+            repo_deps |= deps - aur_names
+        # Turns on the shared compiler cache for C/C++ builds
+        if aur_pkgs:
+            repo_deps.add("ccache")
+
+        log("[*] Installing yay packages from repos and AUR build dependencies")
+        # makepkg runs without -s, every build fails if its dependencies didn't install
+        if repo_pkgs:
+            self.install_repo_pkgs(repo_pkgs, "", "Yay.Pkgs not in the repos or AUR")
+        if repo_deps:
+            self.install_repo_pkgs(sorted(repo_deps), "--asdeps ",
+                                   "AUR dependencies not in the repos, add them to Yay.Pkgs")
+        if aur_pkgs:
+            # Only this install's builds count towards the hit rate
+            ccache = self.build_cache.ccache_command("/" + TARGET_BUILD_CACHE, "--zero-stats")
+            execute("su {}".format(sudo_user), stdin=ccache, chroot_dir=mnt_path)
+
+        # Packages later waves build against are installed as soon as their wave is done,
+        # everything else waits for the final transaction
+        waves = build_waves(aur_pkgs)
+        needed_later = set()
+        for pkg, (_, deps) in aur_pkgs.items():
+            needed_later |= {other for other in aur_pkgs if other != pkg and
+                             (aur_pkgs[other][0] | {other}) & deps}
+
+        final_files = []
+        for wave in waves:
+            workers = min(jobs, len(wave))
+            pkg_jobs = max(1, jobs // workers)
+            log("[*] Building {} with {} jobs each".format(", ".join(wave), pkg_jobs))
+            results = parallel_map(lambda pkg: self.build_aur_pkg(AUR_REPO.format(pkg), pkg_dirs[pkg],
+                                                                  install_deps=False, jobs=pkg_jobs), wave, workers)
+
+            dep_files = []
+            for pkg, pkg_files in zip(wave, results):
+                if pkg in needed_later:
+                    dep_files += pkg_files
+                else:
+                    final_files += pkg_files
+            if dep_files:
+                execute("pacman -U --noconfirm {}".format(" ".join(dep_files)), chroot_dir=mnt_path)
+
+        if final_files:
+            execute("pacman -U --noconfirm {}".format(" ".join(final_files)), chroot_dir=mnt_path)
+        self.remove_built_pkgs([pkg_dirs[pkg] for pkg in aur_pkgs])
+
+    def remove_built_pkgs(self, pkg_dirs):
+        """
+        Deletes the package files makepkg left in build dirs (paths in the new install) once
+        they're installed, so they don't end up in the installed system or golden images
+        """
+        mnt_path = self.config["mount_path"]
+        if not pkg_dirs:
+            return
+        dirs = " ".join(mnt_path + pkg_dir for pkg_dir in pkg_dirs)
+        execute("find {} -maxdepth 1 -type f -name *.pkg.tar* -delete".format(dirs))
 
-        # yay cannot be run as root
+    def install_repo_pkgs(self, pkgs, args, missing_msg):
+        """
+        Installs pkgs from the repos in one transaction with extra pacman args
+        One unknown name fails the whole transaction, so on failure every name is looked
+        up on its own and the ones pacman can't resolve are raised with missing_msg
+        """
+        mnt_path = self.config["mount_path"]
+        proc = execute("pacman -S --needed {}--noconfirm {}".format(args, " ".join(pkgs)), chroot_dir=mnt_path)
+        if proc.returncode == 0:
+            return
+
+        # -Sp resolves provides and groups too, without installing anything
+        missing = [pkg for pkg in pkgs if execute("pacman -Sp {}".format(pkg), chroot_dir=mnt_path).returncode != 0]
+        if missing:
+            raise Exception("{} - {}".format(missing_msg, " ".join(missing)))
+        raise Exception("pacman failed to install {}".format(" ".join(pkgs)))
+
+    def git_clone(self, repo, dest, ref="", origin=""):
+        """
+        Clones the latest commit of repo, or of ref if set, to dest in the new install as the sudo user
+        ref can be a branch, tag or full commit sha. origin replaces the remote url after cloning
+        Remote repos are cloned from their mirror in git_cache_dir when there is one
+        Logs time taken and git data written, returns True if the clone worked
+        """
+        mnt_path = self.config["mount_path"]
+        su = "su {}".format(self.config["sudo_user"])
+
+        source, git = self.git_source(repo)
+        if source != repo:
+            # The clone should still pull from the real repo later
+            origin = origin or repo
+            repo = source
+
+        if repo.endswith(GIT_BUNDLE_SUFFIX):
+            # Bundles can't be cloned shallow, they're local anyway
+            cmd = "git clone -q {} {}".format(repo, dest)
+            if ref != "":
+                cmd += " && git -C {} checkout -q {}".format(dest, ref)
+        elif GIT_SHA.match(ref):
+            # Servers only give out single commits by their full sha
+            cmd = "git init -q {d} && git -C {d} remote add origin {r} && " \
+                  "{git} -C {d} fetch -q --depth 1 origin {ref} && git -C {d} checkout -q FETCH_HEAD".format(
+                      d=dest, r=repo, ref=ref, git=git)
+        else:
+            branch = "--branch {} ".format(ref) if ref != "" else ""
+            cmd = "{} -c advice.detachedHead=false clone -q --depth 1 --single-branch {}{} {}".format(
+                git, branch, repo, dest)
+        if origin != "":
+            cmd += " && git -C {} remote set-url origin {}".format(dest, origin)
+
+        start = time.time()
+        proc = execute(su, stdin=cmd, chroot_dir=mnt_path)
+        self.report_clone(repo, dest, start)
+        return proc.returncode == 0
+
+    def git_source(self, repo):
+        """
+        Returns (url, git command) to clone repo with in the new install
+        Remote repos come from their freshly updated mirror, as a file:// url so clones can be shallow
+        """
+        if self.git_cache is None or "://" not in repo or repo.startswith("file://"):
+            return repo, "git"
+        mirror = self.git_cache.update(repo)
+        if mirror is None:
+            return repo, "git"
+        return "file:///{}/{}".format(TARGET_GIT_CACHE, mirror), "git -c {}".format(GIT_SAFE_DIRECTORY)
+
+    def report_clone(self, repo, dest, start):
+        """Logs how long a clone to dest took, and how much git data it wrote"""
+        git_dir = "{}{}/.git".format(self.config["mount_path"], dest)
+        log("[+] Cloned {} in {:.1f}s, {:.2f} MB of git data".format(repo, time.time() - start,
+                                                                    dir_size(git_dir) / MB))
+
+    def clone_aur_pkg(self, repo, pkg_dir, ref=""):
+        """Clones an AUR package to pkg_dir, returns False if the AUR has no such package"""
+        mnt_path = self.config["mount_path"]
+        self.git_clone(repo, pkg_dir, ref)
+
+        # The AUR hands back an empty repo for packages it doesn't have
+        return path_exists("{}{}/PKGBUILD".format(mnt_path, pkg_dir))
+
+    def build_aur_pkg(self, repo, pkg_dir, install_deps=True, jobs=0):
+        """
+        Returns the package files (paths in the new install) for a cloned AUR package
+        Builds with makepkg on a cache miss and stores the result
+        install_deps lets makepkg install missing repo dependencies, only one build
+        at a time may do that. jobs sets make's parallelism
+        """
+        mnt_path = self.config["mount_path"]
+        sudo_user = self.config["sudo_user"]
         su = "su {}".format(sudo_user)
-        yay_cmd = "yay -Sy --noconfirm"
 
-        log("[*] Installing yay packages")
-        execute(su, stdin=yay_cmd, chroot_dir=mnt_path, interactive=True)
+        key = self.aur_cache.key(mnt_path + pkg_dir)
+        cached = self.aur_cache.lookup(key)
+        if cached:
+            log("[+] Using cached build from {}".format(repo))
+            pkg_files = ["/{}/{}/{}".format(TARGET_AUR_CACHE, key, name) for name in cached]
+            return [path for path in pkg_files if "-debug-" not in os.path.basename(path)]
+
+        # -s installs repo dependencies, sudo is passwordless until the install finishes
+        makepkg = "MAKEPKG_CONF={} makepkg".format(MAKEPKG_PROFILE)
+        build = makepkg + (" -s --noconfirm" if install_deps else " --noconfirm")
+        if jobs > 0:
+            build = "MAKE_JOBS={} {}".format(jobs, build)
+        proc = execute(su, stdin="cd {}; {}".format(pkg_dir, build), chroot_dir=mnt_path)
+        if proc.returncode != 0:
+            raise Exception("makepkg failed for {}".format(repo))
+
+        # Same config so the file names match what was built
+        proc = execute(su, stdin="cd {}; {} --packagelist".format(pkg_dir, makepkg), chroot_dir=mnt_path)
+        pkg_files = [line.strip() for line in proc.stdout.splitlines() if line.strip().endswith(PKG_SUFFIXES)]
+        if not pkg_files and isinstance(get_executor(), DryRunExecutor):
+            # Nothing was built, makepkg succeeding is all a dry run can go on. Stand in a
+            # package named after the build dir so the rest of the install is planned
+            pkg_files = ["{}/{}{}".format(pkg_dir, os.path.basename(pkg_dir), self.config["makepkg_pkgext"])]
+        if key is not None:
+            self.aur_cache.store(key, [mnt_path + path for path in pkg_files])
+
+        # Debug packages are kept in the cache but not installed
+        return [path for path in pkg_files if "-debug-" not in os.path.basename(path)]
 
     def install_ohmyzsh(self):
         """Install ohmyzsh, for terminal themes and prettiness"""
@@ -380,11 +1446,32 @@ class Installer:
         sudo_user = self.config["sudo_user"]
 
         # su to sudoer and run ohmyzsh install cmd (I prefer this install method to package manager)
+        # RUNZSH and CHSH stop the installer prompting or starting a shell, the shell is changed below
+        # The installer already clones shallow, BRANCH pins it to a branch or tag
         su = "su {}".format(sudo_user)
-        cmd = self.config["ohmyzsh_install_cmd"]
+        env = "RUNZSH=no CHSH=no"
+        if self.config["ohmyzsh_ref"] != "":
+            env += " BRANCH={}".format(self.config["ohmyzsh_ref"])
+        cmd = "export {}; {}".format(env, self.config["ohmyzsh_install_cmd"])
+        if self.config["offline_dir"] != "":
+            # The installer clones ohmyzsh from REMOTE
+            offline_dir = "/" + TARGET_OFFLINE
+            cmd = "export {} REMOTE={}/{}; sh {}/{}".format(
+                env, offline_dir, OFFLINE_OHMYZSH, offline_dir, OFFLINE_OHMYZSH_INSTALL)
+        else:
+            source, git = self.git_source(OHMYZSH_REPO)
+            if source != OHMYZSH_REPO:
+                # Clone from the mirror, then point origin back at github for omz update
+                safe_dir = GIT_SAFE_DIRECTORY.split("=", 1)
+                cmd = "export {} REMOTE={} GIT_CONFIG_COUNT=1 GIT_CONFIG_KEY_0={} GIT_CONFIG_VALUE_0={}; {} " \
+                      "&& git -C ~/.oh-my-zsh remote set-url origin {}".format(
+                          env, source, safe_dir[0], safe_dir[1], self.config["ohmyzsh_install_cmd"], OHMYZSH_REPO)
 
         log("[*] Installing ohmyzsh")
-        execute(su, stdin=cmd, chroot_dir=mnt_path, interactive=True)
+        start = time.time()
+        execute(su, stdin=cmd, chroot_dir=mnt_path)
+        self.report_clone("ohmyzsh", "/home/{}/.oh-my-zsh".format(sudo_user), start)
+        execute("chsh -s /usr/bin/zsh {}".format(sudo_user), chroot_dir=mnt_path)
 
     def configure(self):
         """Clone dotfiles and configure user settings"""
@@ -398,14 +1485,20 @@ class Installer:
         # set user to sudoer so file permissions are correct
         # then clone dotfiles repo, and run configure script
         su = "su {}".format(sudo_user)
-        clone_cmd = "git clone {} {}".format(dotfiles_repo, dotfiles_dir)
         # Must be run from dotfiles directory
         config_cmd = "cd {}; python configure.py".format(dotfiles_dir)
 
         log("[*] Cloning dotfiles")
-        execute(su, stdin=clone_cmd, chroot_dir=mnt_path, interactive=True)
+        if self.config["offline_dir"] != "":
+            # Clone the bundle, then point origin back at the real repo for later pulls
+            bundle = "/{}/{}".format(TARGET_OFFLINE, OFFLINE_DOTFILES)
+            cloned = self.git_clone(bundle, dotfiles_dir, self.config["dotfiles_ref"], origin=dotfiles_repo)
+        else:
+            cloned = self.git_clone(dotfiles_repo, dotfiles_dir, self.config["dotfiles_ref"])
+        if not cloned:
+            raise Exception("Failed to clone dotfiles")
         log("[*] Running dotfiles config script")
-        execute(su, stdin=config_cmd, chroot_dir=mnt_path, interactive=True)
+        execute(su, stdin=config_cmd, chroot_dir=mnt_path)
 
 if __name__ == "__main__":
     main()
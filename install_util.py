@@ -10,14 +10,81 @@
 
 from urllib import request
 from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from collections import deque
+from image_stream import StreamPipeline
 import subprocess
+import threading
+import getpass
+import json
+import gzip
+import random
+import socket
 import re
 import os
+import time
 
 INSTALL_SETTINGS = {"luks_name", "tz.region", "tz.city", "hostname", "mount_path", "sudo_user"}
 
 # Chroot string for execute
 CHROOT = "arch-chroot"
+# Used instead of arch-chroot when a ChrootSession has already set up the mounts
+# Each command gets its own pid namespace like arch-chroot, daemons it leaves behind (eg. gpg-agent
+# from makepkg's PGP checks) are killed when it exits instead of keeping the mounts busy
+CHROOT_PLAIN = "unshare --fork --pid chroot"
+
+# API filesystems arch-chroot mounts into the chroot - (source, target, mount args)
+CHROOT_MOUNTS = [
+    ("proc", "proc", "-t proc -o nosuid,noexec,nodev"),
+    ("sys", "sys", "-t sysfs -o nosuid,noexec,nodev,ro"),
+    ("efivarfs", "sys/firmware/efi/efivars", "-t efivarfs -o nosuid,noexec,nodev"),
+    ("udev", "dev", "-t devtmpfs -o mode=0755,nosuid"),
+    ("devpts", "dev/pts", "-t devpts -o mode=0620,gid=5,nosuid,noexec"),
+    ("shm", "dev/shm", "-t tmpfs -o mode=1777,nosuid,nodev"),
+    ("/run", "run", "--bind --make-private"),
+    ("tmp", "tmp", "-t tmpfs -o mode=1777,strictatime,nodev,nosuid"),
+]
+EFIVARS_DIR = "/sys/firmware/efi/efivars"
+RESOLV_CONF = "/etc/resolv.conf"
+
+# Chroot dirs with an active ChrootSession, execute skips arch-chroot for these
+_chroot_sessions = {}
+
+# Lines of command output execute keeps in memory, older lines are only in the step log
+OUTPUT_MAX_LINES = 1000
+# Commands run outside of a step log here
+DEFAULT_STEP = "install"
+
+# Directory execute tees command output to, one file per step. Blank disables logging
+_output_log_dir = ""
+# Name of the step running on each worker thread
+_current = threading.local()
+
+# JSON lines file execute writes a trace record to for every command. Blank disables the file
+_trace_file = ""
+# Trace records from this run, for the summary
+_trace_records = []
+_trace_lock = threading.Lock()
+# Number of slowest commands shown in the trace summary
+TRACE_SUMMARY_SLOWEST = 10
+
+# Number of steps run_steps will run at once
+STEP_WORKERS = 4
+# How many running steps may use each resource at the same time
+# tty is exclusive so interactive steps never fight over the console
+STEP_RESOURCES = {"disk": 1, "chroot": 4, "network": 2, "tty": 1}
+
+# Units for sizes in config, same as lvcreate
+KB = 1024
+MB = KB * 1024
+MEMINFO = "/proc/meminfo"
+SYS_BLOCK = "/sys/class/block"
+SIZE_UNITS = {"K": KB, "M": MB, "G": MB * 1024, "T": MB * 1024 * 1024}
+
+# Answer a dry run gives to password prompts
+DRY_RUN_SECRET = "dry-run"
+# Replaces passwords in recorded install archives
+REDACTED = "<redacted>"
 
 # Escape characters to format text color in log
 FG_WHITE = '\u001b[37m'
@@ -37,45 +104,962 @@ def has_network(timeout=5):
 def validate_file_paths(paths):
     """Takes a list of file paths, checks they exist, throws an exception if not"""
     for path in paths:
-        if not os.path.exists(path):
+        if not path_exists(path):
             raise Exception("{} does not exist".format(path))
 
-def execute(cmd, stdin="", outfile="", chroot_dir="", interactive=False):
+def set_output_log_dir(log_dir):
+    """Sets where execute writes per step output logs"""
+    global _output_log_dir
+    _output_log_dir = log_dir
+
+def set_trace_file(trace_file):
+    """Sets the JSON lines file execute appends a trace record to for every command"""
+    global _trace_file
+    _trace_file = trace_file
+
+def current_step():
+    """Name of the step running on this thread"""
+    return getattr(_current, "step", DEFAULT_STEP)
+
+def execute(cmd, stdin="", outfile="", chroot_dir="", interactive=False, on_output=None):
+    """
+    Runs cmd with the current executor and returns a CompletedProcess
+    Non-interactive output is read line by line as it's produced, written to the
+    current step's log file and passed to on_output. Only the last OUTPUT_MAX_LINES
+    lines are kept for the returned stdout. With outfile set, output goes straight
+    to the file and isn't kept at all
+    """
     if outfile != "" and interactive:
         log("[!] Cannot execute in interactive mode and save output to file")
 
-    if chroot_dir != "":
+    if chroot_dir != "" and chroot_dir in _chroot_sessions:
+        cmd = "{} {} {}".format(CHROOT_PLAIN, chroot_dir, cmd)
+    elif chroot_dir != "":
         cmd = "{} {} {}".format(CHROOT, chroot_dir, cmd)
     cmd = cmd.split(' ')
 
-    args = {"encoding": "utf-8"}
-    if stdin != "":
-        args["input"] = stdin
-    if not interactive:
-        args["stdout"] = subprocess.PIPE    # in non-interactive mode output can be processed
+    output = deque(maxlen=OUTPUT_MAX_LINES)
+    log_file = _open_step_log(cmd)
+
+    def handle_line(line):
+        output.append(line)
+        if log_file is not None:
+            log_file.write(line)
+        if on_output is not None:
+            on_output(line)
+
+    start = time.monotonic()
+    try:
+        returncode, usage, output_bytes = _executor.run(cmd, stdin, outfile, interactive, handle_line)
+    finally:
+        if log_file is not None:
+            log_file.close()
+    end = time.monotonic()
+
+    _trace(cmd, start, end, returncode, usage, output_bytes)
+    return subprocess.CompletedProcess(cmd, returncode, "".join(output))
+
+def stream(source, cmds, on_progress=None):
+    """
+    Pipes source (a file path or URL) through cmds, a list of command strings, with
+    every stage running at once. on_progress is called with the pipeline's stats
+    as it runs. Returns bytes read from source, raises if any stage fails
+    """
+    cmds = [cmd.split(' ') for cmd in cmds]
+    start = time.monotonic()
+    returncode, read_bytes = 1, 0
+    try:
+        read_bytes = _executor.stream(source, cmds, on_progress)
+        returncode = 0
+    finally:
+        argv = [source] + [arg for args in cmds for arg in ["|"] + args]
+        _trace(argv, start, time.monotonic(), returncode, None, read_bytes)
+    return read_bytes
+
+def set_executor(executor):
+    """Sets the backend execute and the file helpers use"""
+    global _executor
+    _executor = executor
+
+def get_executor():
+    return _executor
+
+class Executor:
+    """
+    Runs commands for execute, and does the file and console io install steps need
+    Backends override these to run an install without touching the machine
+    """
+    def run(self, cmd, stdin, outfile, interactive, handle_line):
+        """
+        Runs cmd (a list of args), passing each line of captured output to handle_line
+        Returns (returncode, rusage or None, output bytes)
+        """
+        raise NotImplementedError
+
+    def stream(self, source, cmds, on_progress):
+        """
+        Feeds source (a file or URL) through cmds (lists of args), each command's
+        output into the next. Returns bytes read, raises if anything failed
+        """
+        raise NotImplementedError
+
+    def path_exists(self, path):
+        return os.path.exists(path)
+
+    def is_mount(self, path):
+        return os.path.ismount(path)
+
+    def make_dirs(self, path):
+        os.makedirs(path, exist_ok=True)
+
+    def remove_file(self, path):
+        os.remove(path)
+
+    def read_file(self, file_path):
+        file = open(file_path, "r")
+        string = file.read()
+        file.close()
+        return string
+
+    def write_file(self, string, file_path):
+        file = open(file_path, "w")
+        file.write(string)
+        file.close()
+
+    def prompt(self, text, secret=False):
+        if secret:
+            return getpass.getpass(text)
+        return input(text)
+
+    # Checks of the host's own state, like its caches, /proc and /sys
+    # Dry runs read the real host for these, a replay answers them from the recording
+
+    def list_dir(self, path):
+        """Sorted names in directory path, None if it isn't a directory"""
+        if not os.path.isdir(path):
+            return None
+        return sorted(os.listdir(path))
+
+    def file_age(self, path):
+        """Seconds since file path was modified, None if it isn't a file"""
+        if not os.path.isfile(path):
+            return None
+        return time.time() - os.path.getmtime(path)
+
+    def read_host_file(self, path):
+        """Contents of file path, None if it isn't a file"""
+        if not os.path.isfile(path):
+            return None
+        return Executor.read_file(self, path)
+
+    def real_path(self, path):
+        return os.path.realpath(path)
+
+    def cpu_count(self):
+        return os.cpu_count() or 1
+
+    def add_secret(self, secret):
+        """Called with each secret prompt_secret accepts"""
+        pass
+
+class RealExecutor(Executor):
+    """Runs commands on this machine"""
+    def run(self, cmd, stdin, outfile, interactive, handle_line):
+        args = {"encoding": "utf-8", "errors": "replace"}
+        if stdin != "":
+            args["stdin"] = subprocess.PIPE
+
+        out_file = None
+        if outfile != "":
+            out_file = open(outfile, "w")
+            args["stdout"] = out_file
+        elif not interactive:
+            args["stdout"] = subprocess.PIPE    # in non-interactive mode output can be processed
+
+        proc = subprocess.Popen(cmd, **args)
+
+        # Feed stdin from another thread so a full stdout pipe can't deadlock us
+        writer = None
+        if stdin != "":
+            writer = threading.Thread(target=_write_stdin, args=(proc, stdin))
+            writer.start()
+
+        output_bytes = 0
+        if proc.stdout is not None:
+            for line in proc.stdout:
+                output_bytes += len(line.encode("utf-8"))
+                handle_line(line)
+
+        # wait4 gives cpu time and peak memory for this command alone, even with other
+        # steps running commands at the same time
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+        if writer is not None:
+            writer.join()
+        if out_file is not None:
+            output_bytes = out_file.tell()
+            out_file.close()
+
+        return proc.returncode, usage, output_bytes
+
+    def stream(self, source, cmds, on_progress):
+        return StreamPipeline(source, cmds).run(on_progress)["fed"][0]
+
+class DryRunExecutor(Executor):
+    """
+    Runs nothing, records the commands and file changes an install would make
+    Every command succeeds instantly with no output, unless it matches one of outputs
+    outputs - list of (regex, stdout, returncode), first match against the command
+              (and its stdin on the next line) gives the commands result
+    answers - list of (regex, answer) for prompts, secret prompts default to DRY_RUN_SECRET
+    """
+    def __init__(self, outputs=(), answers=(), verbose=True):
+        self.outputs = [(re.compile(match), stdout, returncode) for match, stdout, returncode in outputs]
+        self.answers = [(re.compile(match), answer) for match, answer in answers]
+        self.verbose = verbose
+        self.plan = []
+        self.lock = threading.Lock()
+
+    def record(self, action, detail):
+        with self.lock:
+            self.plan.append({"step": current_step(), "action": action, "detail": detail})
+        if self.verbose:
+            print("[plan] {:<24}{:<8}{}".format(current_step(), action, detail))
+
+    def write_plan(self, plan_file):
+        """Writes the recorded plan as JSON lines"""
+        file = open(plan_file, "w")
+        for entry in self.plan:
+            file.write(json.dumps(entry) + "\n")
+        file.close()
+
+    def delay(self, cmd):
+        """Time a command takes, none for a dry run"""
+        pass
+
+    def run(self, cmd, stdin, outfile, interactive, handle_line):
+        cmd = " ".join(cmd)
+        self.record("run", cmd)
+
+        # Outputs can match on stdin too, for scripts run through su
+        match_text = cmd if stdin == "" else cmd + "\n" + stdin
+        stdout, returncode = "", 0
+        for match, canned_stdout, canned_returncode in self.outputs:
+            if match.search(match_text):
+                stdout, returncode = canned_stdout, canned_returncode
+                break
+
+        self.delay(cmd)
+        if outfile != "":
+            self.write_file(stdout, outfile)
+        else:
+            for line in stdout.splitlines(keepends=True):
+                handle_line(line)
+        return returncode, None, len(stdout.encode("utf-8"))
+
+    def stream(self, source, cmds, on_progress):
+        cmd = stream_command(source, cmds)
+        self.record("stream", cmd)
+        self.delay(cmd)
+        return 0
+
+    def path_exists(self, path):
+        return True
+
+    def is_mount(self, path):
+        return False
+
+    def make_dirs(self, path):
+        self.record("mkdir", path)
+
+    def remove_file(self, path):
+        self.record("remove", path)
+
+    def read_file(self, file_path):
+        return ""
+
+    def write_file(self, string, file_path):
+        self.record("write", "{} ({} bytes)".format(file_path, len(string)))
+
+    def prompt(self, text, secret=False):
+        for match, answer in self.answers:
+            if match.search(text):
+                return answer
+        if secret:
+            return DRY_RUN_SECRET
+        raise Exception("No answer given for prompt: {}".format(text))
+
+class SimulatedExecutor(DryRunExecutor):
+    """
+    Dry run where commands take time, for benchmarking install orchestration
+    latencies - list of (regex, distribution), first match gives the time a command takes
+    A distribution is a dict, eg. {"dist": "normal", "mean": 30, "stddev": 5}, see sample_latency
+    """
+    def __init__(self, outputs=(), answers=(), latencies=(), default_latency=None, verbose=False):
+        DryRunExecutor.__init__(self, outputs, answers, verbose)
+        self.latencies = [(re.compile(match), dist) for match, dist in latencies]
+        self.default_latency = default_latency
+
+    def delay(self, cmd):
+        dist = self.default_latency
+        for match, latency in self.latencies:
+            if match.search(cmd):
+                dist = latency
+                break
+        if dist is not None:
+            time.sleep(sample_latency(dist))
+
+def sample_latency(dist):
+    """
+    Seconds drawn from a latency distribution
+    fixed: seconds, uniform: min max, normal: mean stddev, lognormal: mu sigma
+    """
+    kind = dist.get("dist", "fixed")
+    if kind == "fixed":
+        value = dist["seconds"]
+    elif kind == "uniform":
+        value = random.uniform(dist["min"], dist["max"])
+    elif kind == "normal":
+        value = random.gauss(dist["mean"], dist["stddev"])
+    elif kind == "lognormal":
+        value = random.lognormvariate(dist["mu"], dist["sigma"])
+    else:
+        raise Exception("Unknown latency distribution {}".format(kind))
+    return max(0.0, value)
+
+def load_simulation(spec_path, simulate=True):
+    """
+    Builds a dry run or simulated executor from a JSON spec file
+    {"outputs": [{"match": "^lsblk", "stdout": "...", "exit_code": 0}],
+     "answers": [{"match": "disk", "answer": "/dev/nvme0n1"}],
+     "latencies": [{"match": "^pacstrap", "dist": "normal", "mean": 300, "stddev": 30}],
+     "default_latency": {"dist": "fixed", "seconds": 0.1}}
+    """
+    spec = {}
+    if spec_path != "":
+        file = open(spec_path, "r")
+        spec = json.load(file)
+        file.close()
+
+    outputs = [(out["match"], out.get("stdout", ""), out.get("exit_code", 0))
+               for out in spec.get("outputs", [])]
+    answers = [(ans["match"], ans["answer"]) for ans in spec.get("answers", [])]
+    if not simulate:
+        return DryRunExecutor(outputs, answers)
+
+    latencies = [(lat["match"], lat) for lat in spec.get("latencies", [])]
+    return SimulatedExecutor(outputs, answers, latencies, spec.get("default_latency"))
+
+class RecordingExecutor(RealExecutor):
+    """
+    Runs commands on this machine and records each one into a gzipped JSON lines archive
+    for ReplayExecutor. Passwords entered at prompts are redacted from stdin and output
+    """
+    def __init__(self, archive_path):
+        self.archive = gzip.open(archive_path, "wt")
+        self.secrets = []
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.write({"type": "header", "version": 3, "host": socket.gethostname(), "time": time.time()})
+
+    def write(self, entry):
+        with self.lock:
+            self.archive.write(json.dumps(entry) + "\n")
+
+    def redact(self, string):
+        for secret in self.secrets:
+            string = string.replace(secret, REDACTED)
+        return string
+
+    def run(self, cmd, stdin, outfile, interactive, handle_line):
+        # Keep what execute keeps, that's all a replay needs to hand back
+        lines = deque(maxlen=OUTPUT_MAX_LINES)
+
+        def record_line(line):
+            lines.append(line)
+            handle_line(line)
+
+        start = time.monotonic()
+        returncode, usage, output_bytes = RealExecutor.run(self, cmd, stdin, outfile, interactive, record_line)
+        self.write({
+            "type": "run",
+            "step": current_step(),
+            "argv": cmd,
+            "stdin": self.redact(stdin),
+            "stdout": self.redact("".join(lines)),
+            "outfile": outfile,
+            "exit_code": returncode,
+            "start": start - self.started,
+            "duration": time.monotonic() - start,
+        })
+        return returncode, usage, output_bytes
+
+    def stream(self, source, cmds, on_progress):
+        start = time.monotonic()
+        read_bytes, error = 0, None
+        try:
+            read_bytes = RealExecutor.stream(self, source, cmds, on_progress)
+            return read_bytes
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            self.write({
+                "type": "stream",
+                "step": current_step(),
+                "source": source,
+                "cmds": cmds,
+                "read_bytes": read_bytes,
+                "error": error,
+                "start": start - self.started,
+                "duration": time.monotonic() - start,
+            })
+
+    def check(self, check, path, result):
+        """Records what a check of the machine returned, a replay gives the same answer"""
+        self.write({"type": "check", "step": current_step(), "check": check, "path": path, "result": result})
+        return result
+
+    def path_exists(self, path):
+        return self.check("path_exists", path, RealExecutor.path_exists(self, path))
+
+    def is_mount(self, path):
+        return self.check("is_mount", path, RealExecutor.is_mount(self, path))
+
+    def list_dir(self, path):
+        return self.check("list_dir", path, RealExecutor.list_dir(self, path))
+
+    def file_age(self, path):
+        return self.check("file_age", path, RealExecutor.file_age(self, path))
 
-    proc = subprocess.run(cmd, **args)
+    def read_host_file(self, path):
+        return self.check("read_host_file", path, RealExecutor.read_host_file(self, path))
 
-    if outfile != "":
-        write_file(proc.stdout, outfile)
+    def real_path(self, path):
+        return self.check("real_path", path, RealExecutor.real_path(self, path))
 
-    return proc
+    def cpu_count(self):
+        return self.check("cpu_count", "", RealExecutor.cpu_count(self))
+
+    def prompt(self, text, secret=False):
+        answer = RealExecutor.prompt(self, text, secret)
+        if not secret:
+            self.write({"type": "prompt", "text": text, "answer": answer})
+        return answer
+
+    def add_secret(self, secret):
+        # Only accepted secrets, a rejected blank one would redact between every character
+        if secret != "":
+            self.secrets.append(secret)
+
+    def close(self):
+        self.write({"type": "footer", "wall": time.monotonic() - self.started})
+        self.archive.close()
+
+class ReplayExecutor(DryRunExecutor):
+    """
+    Runs an install against an archive from RecordingExecutor. Each command gets the output
+    and exit code recorded for it, after sleeping its recorded duration times scale
+    Commands are matched on their args and stdin, since most chroot work is the same
+    su command with a different script. Commands the archive doesn't have, commands whose
+    stdin changed, recorded commands never run and commands that moved to another step
+    are collected for report()
+    """
+    def __init__(self, archive_path, scale=1.0):
+        # Recorded entries by command, in the order they ran
+        self.runs = {}
+        # Recorded answers to checks of the machine by (check, path), and the last one given
+        self.checks = {}
+        self.last_checks = {}
+        self.recorded_wall = None
+        answers = []
+
+        archive = gzip.open(archive_path, "rt")
+        for line in archive:
+            entry = json.loads(line)
+            if entry["type"] == "run":
+                self.runs.setdefault(" ".join(entry["argv"]), []).append(entry)
+            elif entry["type"] == "stream":
+                self.runs.setdefault(stream_command(entry["source"], entry["cmds"]), []).append(entry)
+            elif entry["type"] == "check":
+                self.checks.setdefault((entry["check"], entry["path"]), deque()).append(entry["result"])
+            elif entry["type"] == "prompt":
+                answers.append(("^" + re.escape(entry["text"]) + "$", entry["answer"]))
+            elif entry["type"] == "footer":
+                self.recorded_wall = entry["wall"]
+        archive.close()
+
+        DryRunExecutor.__init__(self, answers=answers, verbose=False)
+        self.scale = scale
+        self.started = time.monotonic()
+        self.unexpected = []
+        self.stdin_changes = []
+        self.step_changes = []
+
+    def take(self, cmd, stdin):
+        """
+        Removes and returns the recorded entry for cmd with stdin, None if there isn't one
+        Entries from the current step are preferred, so steps running in a different order
+        than recorded still get their own outputs. A command recorded with other stdin is
+        still used, as a changed script, so the rest of the install replays
+        """
+        step = current_step()
+        with self.lock:
+            entries = self.runs.get(cmd)
+            if not entries:
+                self.unexpected.append((step, cmd))
+                return None
+
+            # min keeps recorded order between equally good matches
+            entry = min(entries, key=lambda e: (e.get("stdin", "") != stdin, e["step"] != step))
+            entries.remove(entry)
+            if entry.get("stdin", "") != stdin:
+                self.stdin_changes.append((step, cmd))
+            if entry["step"] != step:
+                self.step_changes.append((entry["step"], step, cmd))
+            return entry
+
+    def run(self, cmd, stdin, outfile, interactive, handle_line):
+        cmd = " ".join(cmd)
+        self.record("run", cmd)
+
+        entry = self.take(cmd, stdin)
+        if entry is None:
+            return 0, None, 0
+
+        time.sleep(entry["duration"] * self.scale)
+        if outfile != "":
+            self.write_file(entry["stdout"], outfile)
+        else:
+            for line in entry["stdout"].splitlines(keepends=True):
+                handle_line(line)
+        return entry["exit_code"], None, len(entry["stdout"].encode("utf-8"))
+
+    def stream(self, source, cmds, on_progress):
+        cmd = stream_command(source, cmds)
+        self.record("stream", cmd)
+
+        entry = self.take(cmd, "")
+        if entry is None:
+            return 0
+
+        time.sleep(entry["duration"] * self.scale)
+        if entry["error"] is not None:
+            raise Exception(entry["error"])
+        return entry["read_bytes"]
+
+    def checked(self, check, path, default):
+        """
+        The recorded answer to a check, in recorded order, so the replay doesn't depend on
+        the machine it runs on. Once they run out the last one is repeated, default if there were none
+        """
+        key = (check, path)
+        with self.lock:
+            results = self.checks.get(key)
+            if results:
+                self.last_checks[key] = results.popleft()
+            return self.last_checks.get(key, default)
+
+    def path_exists(self, path):
+        return self.checked("path_exists", path, True)
+
+    def is_mount(self, path):
+        return self.checked("is_mount", path, False)
+
+    def list_dir(self, path):
+        return self.checked("list_dir", path, None)
+
+    def file_age(self, path):
+        return self.checked("file_age", path, None)
+
+    def read_host_file(self, path):
+        return self.checked("read_host_file", path, None)
+
+    def real_path(self, path):
+        return self.checked("real_path", path, path)
+
+    def cpu_count(self):
+        return self.checked("cpu_count", "", 1)
+
+    def prompt(self, text, secret=False):
+        # Recorded stdin has passwords redacted, replayed stdin has to match it
+        if secret:
+            return REDACTED
+        return DryRunExecutor.prompt(self, text, secret)
+
+    def report(self):
+        """Logs how the replay differed from the recording, returns False if it did"""
+        missing = [(entry["step"], cmd) for cmd, entries in self.runs.items() for entry in entries]
+
+        log("[*] Replay finished in {:.1f}s".format(time.monotonic() - self.started))
+        if self.recorded_wall is not None:
+            log("[*] Recorded install took {:.1f}s, replayed with time scale {}".format(
+                self.recorded_wall, self.scale))
+        for step, cmd in self.unexpected:
+            log("[!] Not in recording: {} - {}".format(step, cmd))
+        for step, cmd in self.stdin_changes:
+            log("[!] Stdin differs from recording: {} - {}".format(step, cmd))
+        for step, cmd in missing:
+            log("[!] Recorded but never run: {} - {}".format(step, cmd))
+        for old_step, new_step, cmd in self.step_changes:
+            log("[!] Moved from {} to {}: {}".format(old_step, new_step, cmd))
+
+        return not (self.unexpected or self.stdin_changes or missing or self.step_changes)
+
+def stream_command(source, cmds):
+    """A streamed pipeline as one command line, cmds is a list of lists of args"""
+    return " | ".join([source] + [" ".join(args) for args in cmds])
+
+def _write_stdin(proc, stdin):
+    try:
+        proc.stdin.write(stdin)
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass    # command exited without reading all its input
+
+def _open_step_log(cmd):
+    """Opens the log file for the current step, stdin isn't logged as it may hold passwords"""
+    if _output_log_dir == "":
+        return None
+    # Created on first use, so a simulated run doesn't leave an empty one behind
+    os.makedirs(_output_log_dir, exist_ok=True)
+    log_file = open(os.path.join(_output_log_dir, current_step() + ".log"), "a", buffering=1)
+    log_file.write("$ {}\n".format(" ".join(cmd)))
+    return log_file
+
+def _trace(cmd, start, end, returncode, usage, output_bytes):
+    """Records how long a command took and what it cost"""
+    # Backends that don't run anything have no resource usage
+    record = {
+        "argv": cmd,
+        "step": current_step(),
+        "start": start,
+        "end": end,
+        "exit_code": returncode,
+        "user_cpu": usage.ru_utime if usage is not None else 0.0,
+        "sys_cpu": usage.ru_stime if usage is not None else 0.0,
+        "max_rss_kb": usage.ru_maxrss if usage is not None else 0,
+        "output_bytes": output_bytes,
+    }
+    with _trace_lock:
+        _trace_records.append(record)
+        if _trace_file != "":
+            file = open(_trace_file, "a")
+            file.write(json.dumps(record) + "\n")
+            file.close()
+
+def print_trace_summary():
+    """Prints time and cpu used by each step, and the slowest commands"""
+    with _trace_lock:
+        records = list(_trace_records)
+    if not records:
+        return
+
+    steps = {}
+    for record in records:
+        totals = steps.setdefault(record["step"], {"cmds": 0, "wall": 0.0, "user": 0.0,
+                                                   "sys": 0.0, "rss": 0, "bytes": 0})
+        totals["cmds"] += 1
+        totals["wall"] += record["end"] - record["start"]
+        totals["user"] += record["user_cpu"]
+        totals["sys"] += record["sys_cpu"]
+        totals["rss"] = max(totals["rss"], record["max_rss_kb"])
+        totals["bytes"] += record["output_bytes"]
+
+    log("[*] Command time by step")
+    print("{:<24}{:>6}{:>10}{:>10}{:>10}{:>12}{:>12}".format(
+        "step", "cmds", "wall s", "user s", "sys s", "peak rss MB", "output KB"))
+    for name, totals in sorted(steps.items(), key=lambda item: -item[1]["wall"]):
+        print("{:<24}{:>6}{:>10.1f}{:>10.1f}{:>10.1f}{:>12.1f}{:>12.1f}".format(
+            name, totals["cmds"], totals["wall"], totals["user"], totals["sys"],
+            totals["rss"] / 1024, totals["bytes"] / 1024))
+
+    log("[*] Slowest commands")
+    records.sort(key=lambda record: record["start"] - record["end"])
+    for record in records[:TRACE_SUMMARY_SLOWEST]:
+        print("{:>8.1f}s  {:<24}{}".format(record["end"] - record["start"], record["step"],
+                                          " ".join(record["argv"])[:80]))
+
+class ChrootSession:
+    """
+    Mounts the API filesystems into a chroot once, so commands run with
+    execute(..., chroot_dir=...) don't pay for arch-chroot's setup and teardown each time
+    """
+    def __init__(self, chroot_dir, binds=()):
+        """binds is a list of (host path, path in chroot) to bind mount for the session"""
+        self.chroot_dir = chroot_dir
+        self.binds = list(binds)
+        self.mounts = []
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def open(self):
+        """Mount everything into the chroot, returns the session"""
+        if self.chroot_dir in _chroot_sessions:
+            raise Exception("Chroot session already active for {}".format(self.chroot_dir))
+
+        log("[*] Setting up chroot in {}".format(self.chroot_dir))
+        try:
+            # pacman looks up the mount the root is on, eg. for CheckSpace, same as arch-chroot
+            # a plain directory (building an image) is bind mounted onto itself first
+            if not is_mount(self.chroot_dir):
+                self.mount(self.chroot_dir, "", "--bind")
+            for source, target, args in CHROOT_MOUNTS:
+                # efivarfs only exists when booted in uefi mode
+                if source == "efivarfs" and not os.path.isdir(EFIVARS_DIR):
+                    continue
+                self.mount(source, target, args)
+            self.mount_resolv_conf()
+            for source, target in self.binds:
+                self.mount(source, target, "--bind")
+        except Exception as e:
+            self.unmount_all()
+            raise e
+
+        _chroot_sessions[self.chroot_dir] = self
+        return self
+
+    def close(self):
+        """Unmount everything, does nothing if the session isn't open"""
+        if _chroot_sessions.get(self.chroot_dir) is not self:
+            return
+        del _chroot_sessions[self.chroot_dir]
+        log("[*] Tearing down chroot in {}".format(self.chroot_dir))
+        self.unmount_all()
+
+    def mount(self, source, target, args):
+        """Mount source onto target (relative to the chroot dir), unmounted when the session ends"""
+        target = os.path.join(self.chroot_dir, target)
+        make_dirs(target)
+
+        proc = execute("mount {} {} {}".format(source, target, args))
+        if proc.returncode != 0:
+            raise Exception("Failed to mount {} on {}".format(source, target))
+        self.mounts.append(target)
+
+    def mount_resolv_conf(self):
+        """Bind hosts resolv.conf so the chroot has working dns, same as arch-chroot"""
+        src = os.path.realpath(RESOLV_CONF)
+        dest = self.chroot_dir + RESOLV_CONF
+        if not os.path.exists(src):
+            return
+
+        # A dangling symlink (eg. systemd-resolved stub) can't be mounted over
+        if not path_exists(dest):
+            if os.path.islink(dest):
+                return
+            write_file("", dest)
+
+        proc = execute("mount {} {} --bind".format(src, dest))
+        if proc.returncode != 0:
+            raise Exception("Failed to mount {} on {}".format(src, dest))
+        self.mounts.append(dest)
+
+    def unmount_all(self):
+        """Unmount in reverse order so nested mounts (eg. dev/pts) go first"""
+        while self.mounts:
+            target = self.mounts.pop()
+            proc = execute("umount {}".format(target))
+            if proc.returncode != 0:
+                log("[!] Failed to unmount {}".format(target))
+
+class Step:
+    """
+    A named install step, the steps that must finish before it and the resources it uses
+    Steps that don't leave anything behind (eg. mounts) set checkpoint=False so they
+    are run again when an install is resumed
+    """
+    def __init__(self, name, func, requires=(), resources=(), checkpoint=True):
+        self.name = name
+        self.func = func
+        self.requires = list(requires)
+        self.resources = list(resources)
+        self.checkpoint = checkpoint
+
+def run_steps(steps, done=(), on_step_done=None, workers=STEP_WORKERS, resources=STEP_RESOURCES):
+    """
+    Runs steps on a pool of worker threads as soon as their requirements have finished
+    and their resources are free. Stops starting new steps after the first failure,
+    waits for running steps, then raises
+    Checkpointed steps named in done are skipped, on_step_done(step, start, end) is
+    called after each step that finishes successfully
+    """
+    names = {step.name for step in steps}
+    for step in steps:
+        for req in step.requires:
+            if req not in names:
+                raise Exception("Step {} requires unknown step {}".format(step.name, req))
+        for res in step.resources:
+            if res not in resources:
+                raise Exception("Step {} uses unknown resource {}".format(step.name, res))
+
+    done = {step.name for step in steps if step.checkpoint and step.name in done}
+    pending = [step for step in steps if step.name not in done]
+    started = {}
+    in_use = {res: 0 for res in resources}
+    running = {}
+    failures = []
+
+    def is_ready(step):
+        if not all(req in done for req in step.requires):
+            return False
+        return all(in_use[res] < resources[res] for res in step.resources)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            # Start everything that's ready, in the order steps were given
+            for step in list(pending):
+                if failures or len(running) >= workers:
+                    break
+                if is_ready(step):
+                    pending.remove(step)
+                    for res in step.resources:
+                        in_use[res] += 1
+                    started[step.name] = time.time()
+                    running[pool.submit(_run_step, step)] = step
+
+            if not running:
+                if pending and not failures:
+                    raise Exception("Steps can never run: {}".format(
+                        ", ".join(step.name for step in pending)))
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                for res in step.resources:
+                    in_use[res] -= 1
+                try:
+                    future.result()
+                    done.add(step.name)
+                    if on_step_done is not None:
+                        on_step_done(step, started[step.name], time.time())
+                except Exception as e:
+                    failures.append("{}: {}".format(step.name, e))
+
+    if failures:
+        raise Exception("Install step failed - {}".format("; ".join(failures)))
+
+def _run_step(step):
+    """Runs a step on a worker thread, tagging the thread so output is logged against the step"""
+    _current.step = step.name
+    try:
+        step.func()
+    finally:
+        _current.step = DEFAULT_STEP
+
+def parallel_map(func, items, workers):
+    """
+    Calls func on every item using up to workers threads, returns results in item order
+    Worker threads log against the calling step
+    """
+    step = current_step()
+
+    def run(item):
+        _current.step = step
+        try:
+            return func(item)
+        finally:
+            _current.step = DEFAULT_STEP
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(run, items))
+
+def path_exists(path):
+    return _executor.path_exists(path)
+
+def is_mount(path):
+    return _executor.is_mount(path)
+
+def make_dirs(path):
+    _executor.make_dirs(path)
+
+def remove_file(path):
+    _executor.remove_file(path)
 
 def write_file(string, file_path):
-    file = open(file_path, "w")
-    file.write(string)
-    file.close()
+    _executor.write_file(string, file_path)
+
+def read_file(file_path):
+    return _executor.read_file(file_path)
+
+def list_dir(path):
+    return _executor.list_dir(path)
+
+def file_age(path):
+    return _executor.file_age(path)
+
+def read_host_file(path):
+    return _executor.read_host_file(path)
+
+def real_path(path):
+    return _executor.real_path(path)
+
+def cpu_count():
+    return _executor.cpu_count()
 
 def replace_in_file(match_line, string, file_path):
-    file = open(file_path, "r")
-    lines = file.readlines()
-    file.close()
-    file = open(file_path, "w")
+    lines = _executor.read_file(file_path).splitlines(keepends=True)
+    new_lines = []
     for line in lines:
         if re.match(match_line, line):
             line = string
-        file.write(line)
-    file.close()
+        new_lines.append(line)
+    _executor.write_file("".join(new_lines), file_path)
+
+def prompt(text):
+    return _executor.prompt(text)
+
+def parse_size(size):
+    """Converts a size like 512M or 16G to bytes"""
+    size = size.strip().upper()
+    if size[-1:] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+def mem_available():
+    """Bytes of memory available without swapping, from /proc/meminfo"""
+    for line in (read_host_file(MEMINFO) or "").splitlines():
+        if line.startswith("MemAvailable:"):
+            # Reported in kB
+            return int(line.split()[1]) * KB
+    raise Exception("MemAvailable missing from {}".format(MEMINFO))
+
+def block_queue(device):
+    """
+    Returns {"rotational": bool, "discard": bool, "size": bytes} for device from sysfs,
+    following symlinks like /dev/vg/root to the dm device. None if sysfs doesn't know the device
+    """
+    block_dir = os.path.join(SYS_BLOCK, os.path.basename(real_path(device)))
+    values = {}
+    for name in ["queue/rotational", "queue/discard_max_bytes", "size"]:
+        value = read_host_file(os.path.join(block_dir, name))
+        if value is None:
+            return None
+        values[name] = int(value.strip())
+    # size is in 512 byte sectors whatever the device's block size
+    return {"rotational": values["queue/rotational"] == 1, "discard": values["queue/discard_max_bytes"] > 0,
+            "size": values["size"] * 512}
+
+def prompt_secret(prompt):
+    """Prompts for a non-empty secret twice until both entries match"""
+    while True:
+        secret = _executor.prompt(prompt, secret=True)
+        if secret == "":
+            log("[!] Cannot be empty, please try again")
+        elif _executor.prompt("Confirm " + prompt[0].lower() + prompt[1:], secret=True) != secret:
+            log("[!] Entries do not match, please try again")
+        else:
+            _executor.add_secret(secret)
+            return secret
+
+_executor = RealExecutor()
 
 def log(string):
     print(FG_RED + string + FG_WHITE)
@@ -0,0 +1,127 @@
+########################################
+#                                      #
+#                                      #
+#        mirrors.py - Tony Ward        #
+#                                      #
+#   Ranks pacman mirrors by download   #
+#   speed before installing packages   #
+#                                      #
+########################################
+
+from install_util import *
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import platform
+import socket
+import json
+import time
+import re
+import os
+
+MIRRORLIST = "/etc/pacman.d/mirrorlist"
+# The mirrorlist before install.py first overwrote it, rankings pick from every server in it
+ORIG_SUFFIX = ".orig"
+# Matches Server lines in a mirrorlist, commented out or not. Group 1 is the comment
+SERVER_LINE = re.compile(r"^\s*(#?)\s*Server\s*=\s*(\S+)")
+
+# Database file downloaded from each mirror to measure its speed
+PROBE_REPO = "core"
+PROBE_FILE = "core.db"
+# Number of mirrors probed at once
+PROBE_WORKERS = 16
+
+def read_mirrorlist(path=MIRRORLIST, active_only=False):
+    """Returns every server url in a mirrorlist, commented out ones too unless active_only is set"""
+    if not path_exists(path):
+        return []
+
+    urls = []
+    for line in read_file(path).splitlines():
+        match = SERVER_LINE.match(line)
+        if match is None or (active_only and match.group(1) == "#"):
+            continue
+        if match.group(2) not in urls:
+            urls.append(match.group(2))
+    return urls
+
+def candidate_servers(path=MIRRORLIST, exclude=()):
+    """
+    Servers a ranking chooses from, every server in the mirrorlist as it was before it was
+    first ranked, so the pool doesn't shrink to the last winners. exclude is left out, eg. a cache proxy
+    """
+    orig = path + ORIG_SUFFIX
+    servers = read_mirrorlist(orig if path_exists(orig) else path)
+    return [server for server in servers if server not in exclude]
+
+def mirror_url(server, repo, arch, file_name):
+    """Fills in a mirrorlist server url, eg. https://host/archlinux/$repo/os/$arch"""
+    url = server.replace("$repo", repo).replace("$arch", arch)
+    return "{}/{}".format(url.rstrip("/"), file_name)
+
+def probe_mirror(server, sample_bytes, timeout):
+    """
+    Measures connect latency and the time to download the first sample_bytes of the
+    core database from a mirror. Returns None if the mirror can't be reached
+    """
+    url = mirror_url(server, PROBE_REPO, platform.machine(), PROBE_FILE)
+    parsed = urlparse(url)
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+
+    try:
+        start = time.monotonic()
+        sock = socket.create_connection((parsed.hostname, port), timeout=timeout)
+        latency = time.monotonic() - start
+        sock.close()
+
+        start = time.monotonic()
+        req = request.Request(url, headers={"Range": "bytes=0-{}".format(sample_bytes - 1)})
+        resp = request.urlopen(req, timeout=timeout)
+        received = len(resp.read(sample_bytes))
+        resp.close()
+        elapsed = time.monotonic() - start
+    except Exception:
+        return None
+
+    if received == 0:
+        return None
+    return {"server": server, "latency": latency, "time": elapsed,
+            "throughput": received / max(elapsed, 1e-6)}
+
+def rank_mirrors(servers, sample_bytes, timeout):
+    """Probes mirrors concurrently, returns results for reachable ones, fastest download first"""
+    if not servers:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(PROBE_WORKERS, len(servers))) as pool:
+        results = pool.map(lambda server: probe_mirror(server, sample_bytes, timeout), servers)
+    ranked = [result for result in results if result is not None]
+    ranked.sort(key=lambda result: (result["time"], result["latency"]))
+    return ranked
+
+def load_ranking(cache_file, servers, ttl):
+    """Returns a cached ranking if it's newer than ttl seconds and was made from the same servers"""
+    if not path_exists(cache_file):
+        return None
+    text = read_file(cache_file)
+    if text == "":
+        return None
+
+    cached = json.loads(text)
+
+    if time.time() - cached["time"] > ttl or sorted(cached["servers"]) != sorted(servers):
+        return None
+    return cached["ranked"]
+
+def save_ranking(cache_file, servers, ranked):
+    write_file(json.dumps({"time": time.time(), "servers": servers, "ranked": ranked}, indent=4), cache_file)
+
+def write_mirrorlist(servers, path=MIRRORLIST):
+    """Writes servers, in order, as a pacman mirrorlist. The first time, the original is kept for candidate_servers"""
+    orig = path + ORIG_SUFFIX
+    if path_exists(path) and not path_exists(orig):
+        write_file(read_file(path), orig)
+
+    lines = ["## Ranked by install.py on {}".format(time.strftime("%Y-%m-%d %H:%M:%S"))]
+    for server in servers:
+        lines.append("Server = {}".format(server))
+    write_file("\n".join(lines) + "\n", path)
@@ -0,0 +1,114 @@
+########################################
+#                                      #
+#                                      #
+#       pkg_cache.py - Tony Ward       #
+#                                      #
+#  Package cache shared by installs    #
+#                                      #
+#                                      #
+########################################
+
+from install_util import *
+import os
+import re
+import time
+
+# <name>-<pkgver>-<pkgrel>-<arch>.pkg.tar[.<compression>]
+PKG_FILE = re.compile(r"^(?P<name>.+)-(?P<version>[^-]+-[^-]+)-(?P<arch>[^-]+)\.pkg\.tar(\.\w+)?$")
+SIG_SUFFIX = ".sig"
+
+class PackageCache:
+    """
+    Pacman package cache on the installer host, shared by every install run on it
+    Counts cache hits and misses per install, and evicts old package versions first,
+    then least recently used packages, to keep the cache under max_size bytes
+    """
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.snapshot = set()
+        self.stats = None
+
+    def packages(self):
+        """Returns a dict for every package file in the cache, sizes include signatures"""
+        if not os.path.isdir(self.cache_dir):
+            return []
+
+        pkgs = []
+        for entry in os.scandir(self.cache_dir):
+            match = PKG_FILE.match(entry.name)
+            if match is None or not entry.is_file():
+                continue
+            stat = entry.stat()
+            size = stat.st_size
+            if os.path.exists(entry.path + SIG_SUFFIX):
+                size += os.path.getsize(entry.path + SIG_SUFFIX)
+            pkgs.append({"file": entry.name, "path": entry.path, "name": match.group("name"),
+                         "version": match.group("version"), "size": size,
+                         "atime": stat.st_atime, "mtime": stat.st_mtime})
+        return pkgs
+
+    def take_snapshot(self):
+        """Remembers what's cached before an install downloads anything"""
+        self.snapshot = {pkg["file"] for pkg in self.packages()}
+
+    def count_hits(self, installed):
+        """
+        Works out which of the installed (name, version) packages came from the cache
+        Hits are marked as used now so eviction treats them as recently used
+        """
+        installed = set(installed)
+        hits, misses, hit_bytes, miss_bytes = 0, 0, 0, 0
+        now = time.time()
+        for pkg in self.packages():
+            if (pkg["name"], pkg["version"]) not in installed:
+                continue
+            if pkg["file"] in self.snapshot:
+                hits += 1
+                hit_bytes += pkg["size"]
+                os.utime(pkg["path"], (now, pkg["mtime"]))
+            else:
+                misses += 1
+                miss_bytes += pkg["size"]
+
+        self.stats = {"hits": hits, "misses": misses, "hit_bytes": hit_bytes, "miss_bytes": miss_bytes}
+        return self.stats
+
+    def evict(self):
+        """Deletes old versions, then least recently used packages, until under max_size"""
+        pkgs = self.packages()
+        total = sum(pkg["size"] for pkg in pkgs)
+        if total <= self.max_size:
+            return 0
+
+        # The most recently downloaded file of each package is its current version
+        newest = {}
+        for pkg in pkgs:
+            if pkg["name"] not in newest or pkg["mtime"] > newest[pkg["name"]]["mtime"]:
+                newest[pkg["name"]] = pkg
+        current = {pkg["file"] for pkg in newest.values()}
+
+        # Old versions go first, each group least recently used first
+        pkgs.sort(key=lambda pkg: (pkg["file"] in current, pkg["atime"]))
+
+        freed = 0
+        for pkg in pkgs:
+            if total - freed <= self.max_size:
+                break
+            remove_file(pkg["path"])
+            if os.path.exists(pkg["path"] + SIG_SUFFIX):
+                remove_file(pkg["path"] + SIG_SUFFIX)
+            freed += pkg["size"]
+
+        log("[*] Evicted {:.1f} MB from package cache".format(freed / MB))
+        return freed
+
+    def report(self):
+        """Logs hit and miss counts for the install"""
+        if self.stats is None:
+            return
+        lookups = self.stats["hits"] + self.stats["misses"]
+        rate = 100 * self.stats["hits"] / lookups if lookups else 0
+        log("[*] Package cache: {} hits ({:.1f} MB), {} misses ({:.1f} MB downloaded), {:.0f}% hit rate".format(
+            self.stats["hits"], self.stats["hit_bytes"] / MB, self.stats["misses"],
+            self.stats["miss_bytes"] / MB, rate))
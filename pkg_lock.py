@@ -0,0 +1,127 @@
+########################################
+#                                      #
+#                                      #
+#       pkg_lock.py - Tony Ward        #
+#                                      #
+#   Locks the exact packages pacstrap  #
+#   installs, and fetches them         #
+#                                      #
+########################################
+
+from install_util import *
+from mirrors import mirror_url
+import platform
+import hashlib
+import tarfile
+import json
+import time
+import os
+
+# Fields read from each package's desc file in a sync database
+DESC_FIELDS = {"%FILENAME%": "filename", "%NAME%": "name", "%VERSION%": "version",
+               "%CSIZE%": "csize", "%ISIZE%": "isize", "%SHA256SUM%": "sha256"}
+# Mirrors tried, in order, for packages that fail to download
+FETCH_SERVERS = 3
+FETCH_PARALLEL = 8
+HASH_CHUNK = 1024 * 1024
+
+def read_sync_db(db_file):
+    """Returns {name: package info} for every package in a pacman sync database"""
+    pkgs = {}
+    db = tarfile.open(db_file)
+    for member in db:
+        if not member.name.endswith("/desc"):
+            continue
+        lines = db.extractfile(member).read().decode("utf-8").splitlines()
+        info = {}
+        for i in range(len(lines) - 1):
+            if lines[i] in DESC_FIELDS:
+                info[DESC_FIELDS[lines[i]]] = lines[i + 1]
+        pkgs[info["name"]] = info
+    db.close()
+    return pkgs
+
+def resolve_lock(db_path, packages):
+    """
+    Resolves the full dependency closure of packages against the sync databases in
+    db_path, which must already be synced. Returns the lock as a dict
+    """
+    # Collect every line, the closure is bigger than what execute keeps
+    lines = []
+    proc = execute("pacman -Sp --noconfirm --dbpath {} --print-format %r/%n {}".format(
+        db_path, " ".join(packages)), on_output=lines.append)
+    if proc.returncode != 0:
+        raise Exception("Could not resolve packages: {}".format(proc.stdout.strip()))
+
+    dbs = {}
+    locked = []
+    for line in lines:
+        line = line.strip()
+        if line.count("/") != 1:
+            continue
+        repo, name = line.split("/")
+        if repo not in dbs:
+            dbs[repo] = read_sync_db(os.path.join(db_path, "sync", repo + ".db"))
+        info = dbs[repo][name]
+        locked.append({"repo": repo, "name": name, "version": info["version"],
+                       "filename": info["filename"], "csize": int(info["csize"]),
+                       "isize": int(info["isize"]), "sha256": info["sha256"]})
+
+    return {"generated": time.time(), "arch": platform.machine(), "requested": sorted(packages),
+            "download_size": sum(pkg["csize"] for pkg in locked),
+            "installed_size": sum(pkg["isize"] for pkg in locked), "packages": locked}
+
+def load_lock(lock_file):
+    file = open(lock_file, "r")
+    lock = json.load(file)
+    file.close()
+    return lock
+
+def save_lock(lock, lock_file):
+    file = open(lock_file, "w")
+    file.write(json.dumps(lock, indent=4))
+    file.close()
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    file = open(path, "rb")
+    for chunk in iter(lambda: file.read(HASH_CHUNK), b""):
+        digest.update(chunk)
+    file.close()
+    return digest.hexdigest()
+
+def missing_packages(lock, cache_dir):
+    """Locked packages that aren't in the cache with the right checksum"""
+    missing = []
+    for pkg in lock["packages"]:
+        path = os.path.join(cache_dir, pkg["filename"])
+        if not os.path.isfile(path) or os.path.getsize(path) != pkg["csize"] or sha256_file(path) != pkg["sha256"]:
+            missing.append(pkg)
+    return missing
+
+def fetch_locked(lock, cache_dir, servers, missing):
+    """
+    Downloads missing, the locked packages missing_packages found aren't cached, with one
+    parallel curl per mirror. Packages a mirror fails on are retried from the next one
+    Only downloaded files are checksummed again. Returns packages still missing
+    """
+    curl_config = os.path.join(cache_dir, ".curl-config")
+
+    for server in servers[:FETCH_SERVERS]:
+        if not missing:
+            break
+        entries = []
+        for pkg in missing:
+            url = mirror_url(server, pkg["repo"], lock["arch"], pkg["filename"])
+            entries.append('url = "{}"\noutput = "{}"\n'.format(url, os.path.join(cache_dir, pkg["filename"])))
+        file = open(curl_config, "w")
+        file.write("".join(entries))
+        file.close()
+
+        execute("curl --parallel --parallel-max {} --fail --no-progress-meter --config {}".format(
+            FETCH_PARALLEL, curl_config))
+        missing = missing_packages({"packages": missing}, cache_dir)
+
+    if os.path.exists(curl_config):
+        os.remove(curl_config)
+    return missing
@@ -0,0 +1,106 @@
+########################################
+#                                      #
+#                                      #
+#    test_mirrors.py - Tony Ward       #
+#                                      #
+#  Mirror ranking against local HTTP   #
+#  servers with injected latency       #
+#                                      #
+########################################
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import tempfile
+import unittest
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mirrors
+
+# Size of the fake core.db each server returns
+DB_SIZE = 64 * 1024
+
+class SlowMirror(BaseHTTPRequestHandler):
+    """Serves DB_SIZE bytes for any path after sleeping the server's delay"""
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        if self.server.fail:
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(DB_SIZE))
+        self.end_headers()
+        self.wfile.write(b"\0" * DB_SIZE)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_mirror(delay, fail=False):
+    """Starts a mirror on a free local port, returns (server, mirrorlist url)"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowMirror)
+    server.daemon_threads = True
+    server.delay = delay
+    server.fail = fail
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}/$repo/os/$arch".format(server.server_address[1])
+
+class RankMirrorsTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def mirror(self, delay, fail=False):
+        server, url = start_mirror(delay, fail)
+        self.servers.append(server)
+        return url
+
+    def test_fastest_first(self):
+        slow, fast, medium = self.mirror(0.3), self.mirror(0.0), self.mirror(0.1)
+        ranked = mirrors.rank_mirrors([slow, fast, medium], DB_SIZE, 5)
+        self.assertEqual([result["server"] for result in ranked], [fast, medium, slow])
+
+    def test_unreachable_and_failing_dropped(self):
+        good, failing = self.mirror(0.0), self.mirror(0.0, fail=True)
+        # Nothing listens on a port that was just closed
+        closed_server, closed = start_mirror(0.0)
+        closed_server.server_close()
+        ranked = mirrors.rank_mirrors([closed, failing, good], DB_SIZE, 5)
+        self.assertEqual([result["server"] for result in ranked], [good])
+
+    def test_timeout(self):
+        ranked = mirrors.rank_mirrors([self.mirror(2.0)], DB_SIZE, 0.5)
+        self.assertEqual(ranked, [])
+
+class MirrorlistTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "mirrorlist")
+        file = open(self.path, "w")
+        file.write("## Worldwide\n#Server = http://a/$repo/os/$arch\nServer = http://b/$repo/os/$arch\n"
+                   "#Server = http://c/$repo/os/$arch\n")
+        file.close()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_candidates_survive_ranking(self):
+        proxy = "http://proxy:8080/$repo/os/$arch"
+        mirrors.write_mirrorlist([proxy, "http://c/$repo/os/$arch"], self.path)
+        self.assertEqual(mirrors.read_mirrorlist(self.path), [proxy, "http://c/$repo/os/$arch"])
+        # Later rankings still choose from the original list, without the proxy
+        self.assertEqual(mirrors.candidate_servers(self.path, exclude=[proxy]),
+                         ["http://a/$repo/os/$arch", "http://b/$repo/os/$arch", "http://c/$repo/os/$arch"])
+        mirrors.write_mirrorlist(["http://a/$repo/os/$arch"], self.path)
+        self.assertEqual(len(mirrors.candidate_servers(self.path)), 3)
+
+    def test_active_only(self):
+        self.assertEqual(mirrors.read_mirrorlist(self.path, active_only=True), ["http://b/$repo/os/$arch"])
+
+if __name__ == "__main__":
+    unittest.main()